@@ -13,7 +13,7 @@ import time
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
 from external_memory import get_external_memory
 from failure_memory import FailureMemory, get_failure_memory
@@ -32,6 +32,14 @@ class PromptContext:
     timestamp: Optional[str] = None  # 可选时间戳
 
 
+class CachedPrompt(NamedTuple):
+    """带缓存构建的结果 (避免每次构建分配信息字典)"""
+    prompt: str  # 完整提示词
+    cache_hit: bool  # 是否命中 KV-Cache
+    cache_key: str  # 缓存键
+    source: str  # "kv_cache" 或 "new_generation"
+
+
 class AttentionManager:
     """注意力管理器 - 实现 Manus 的注意力操纵技巧
 
@@ -159,7 +167,7 @@ class AttentionManager:
         include_meta_prompt: bool = True,
         claude_md_content: Optional[str] = None,
         ttl_seconds: int = 3600,
-    ) -> Tuple[str, Dict[str, Any]]:
+    ) -> CachedPrompt:
         """构建 KV-Cache 优化的提示词（带缓存支持）
 
         结构 (从静态到动态):
@@ -186,7 +194,7 @@ class AttentionManager:
             ttl_seconds: 缓存生存时间（秒）
 
         Returns:
-            Tuple[优化后的完整提示词, 缓存信息字典]
+            CachedPrompt(优化后的完整提示词, 是否命中, 缓存键, 来源)
         """
         # 生成缓存键
         cache_key = self._kv_cache.generate_cache_key(
@@ -195,17 +203,12 @@ class AttentionManager:
 
         # 尝试从缓存获取
         cached_prompt = self._kv_cache.get_cached_prompt(cache_key)
-        cache_info = {"cache_hit": False, "cache_key": cache_key}
 
         if cached_prompt:
             # 缓存命中：直接返回缓存的提示词
             # 注意：这里假设动态内容（工作记忆、失败经验等）变化不大
             # 对于精确匹配的场景，这种简单缓存是有效的
-            cache_info.update({
-                "cache_hit": True,
-                "source": "kv_cache",
-            })
-            return cached_prompt, cache_info
+            return CachedPrompt(cached_prompt, True, cache_key, "kv_cache")
 
         # 缓存未命中：正常构建提示词
         prompt = self.build_optimized_prompt(
@@ -226,12 +229,7 @@ class AttentionManager:
             ttl_seconds=ttl_seconds,
         )
 
-        cache_info.update({
-            "cache_hit": False,
-            "source": "new_generation",
-        })
-
-        return prompt, cache_info
+        return CachedPrompt(prompt, False, cache_key, "new_generation")
 
     def get_cache_stats(self) -> Dict[str, Any]:
         """获取KV-Cache统计信息
@@ -433,11 +431,12 @@ class StablePromptBuilder:
         """构建提示词并返回缓存分析（使用真正的KV-Cache）"""
 
         # 使用带缓存的构建方法
-        prompt, cache_info = self.am.build_optimized_prompt_with_cache(
+        result = self.am.build_optimized_prompt_with_cache(
             user_input=user_input,
             chat_id=chat_id,
             **kwargs
         )
+        prompt = result.prompt
 
         # 获取提示词统计信息
         stats = self.am.get_prompt_stats(prompt)
@@ -455,9 +454,9 @@ class StablePromptBuilder:
         return prompt, {
             "cache_efficiency": cache_efficiency,
             "optimization_hints": optimization_hints,
-            "cache_hit": cache_info.get("cache_hit", False),
-            "cache_key": cache_info.get("cache_key", ""),
-            "cache_source": cache_info.get("source", "unknown"),
+            "cache_hit": result.cache_hit,
+            "cache_key": result.cache_key,
+            "cache_source": result.source,
             **stats
         }
 
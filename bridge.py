@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 """MateCode - Claude Code Telegram Bridge (Polling Mode)"""
 
+import functools
+import http.client
 import json
+import logging
+import mmap
 import os
 import re
 import subprocess
 import threading
 import time
-import urllib.request
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, List, Optional, Any
 import queue
@@ -16,6 +22,26 @@ from memory import get_memory
 from attention_manager import AttentionManager, StablePromptBuilder
 from failure_memory import get_failure_memory
 
+try:
+    from watchfiles import watch
+except ImportError:  # Optional: fall back to polling the transcript dirs
+    watch = None
+
+try:
+    import orjson
+except ImportError:  # Optional: faster JSON for Telegram payloads and transcripts
+    orjson = None
+
+if orjson is not None:
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+else:
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+    _json_loads = json.loads
+
+logger = logging.getLogger(__name__)
+
 
 class Config:
     """Centralized configuration management."""
@@ -29,6 +55,7 @@ class Config:
     PENDING_FILE = CLAUDE_DIR / "telegram_pending"
     HISTORY_FILE = CLAUDE_DIR / "history.jsonl"
     UPDATE_OFFSET_FILE = CLAUDE_DIR / "telegram_offset"
+    TRANSCRIPT_DIRS = (CLAUDE_DIR / "transcripts", CLAUDE_DIR / "projects")
 
     # Memory settings
     MEMORY_ENABLED = os.environ.get("MEMORY_ENABLED", "true").lower() == "true"
@@ -39,6 +66,12 @@ class Config:
     KV_CACHE_ENABLED = os.environ.get("KV_CACHE_ENABLED", "true").lower() == "true"
     KV_CACHE_TTL = int(os.environ.get("KV_CACHE_TTL", "3600"))  # 1 hour default
 
+    # Number of worker threads handling Telegram updates
+    HANDLER_WORKERS = int(os.environ.get("HANDLER_WORKERS", "8"))
+
+    # Logging - set LOG_LEVEL=DEBUG to see per-message tracing
+    LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
     # Telegram settings - disable attention manager for raw messages
     TELEGRAM_RAW_MESSAGES = os.environ.get("TELEGRAM_RAW_MESSAGES", "true").lower() == "true"
 
@@ -59,11 +92,11 @@ class Config:
         {"command": "kvcache", "description": "KV-Cache statistics: /kvcache [clear]"},
     ]
 
-    BLOCKED_COMMANDS = {
+    BLOCKED_COMMANDS = frozenset({
         "/mcp", "/help", "/settings", "/config", "/model", "/compact", "/cost",
         "/doctor", "/init", "/login", "/logout", "/memory", "/permissions",
         "/pr", "/review", "/terminal", "/vim", "/approved-tools", "/listen"
-    }
+    })
 
     # Auto-memory instruction
     DEFAULT_AUTO_MEMORY_INSTRUCTION = """【记忆模式 - 系统编程优化版】
@@ -94,9 +127,88 @@ key  = FTS5删除顺序错误，需先删索引再删主表
 --"""
 
 
+class BoundedLRU:
+    """Thread-safe, size- and age-bounded mapping for per-chat session caches.
+
+    Entries are ordered by last write; the oldest entry is evicted once
+    ``maxsize`` is exceeded, and entries older than ``ttl`` seconds are
+    treated as missing so chats that never get a reply cannot leak.
+    Handler workers and the response monitor share instances, so every
+    operation runs under an internal lock.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self) -> None:
+        # Caller holds self._lock
+        cutoff = time.monotonic() - self.ttl
+        while self._data:
+            stamp, _ = next(iter(self._data.values()))
+            if stamp >= cutoff:
+                break
+            self._data.popitem(last=False)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            self._expire()
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __getitem__(self, key: str) -> Any:
+        with self._lock:
+            self._expire()
+            return self._data[key][1]
+
+    def __contains__(self, key: object) -> bool:
+        with self._lock:
+            self._expire()
+            return key in self._data
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._expire()
+            return len(self._data)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            self._expire()
+            entry = self._data.get(key)
+        return entry[1] if entry is not None else default
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            self._expire()
+            entry = self._data.pop(key, None)
+        return entry[1] if entry is not None else default
+
+
+@dataclass(slots=True)
+class ChatState:
+    """Per-chat state for the in-flight request (one lookup per message)."""
+    last_msg: str = ""
+    last_prompt: str = ""
+
+
 # Global state
-recent_messages: Dict[str, str] = {}
-recent_full_prompts: Dict[str, str] = {}
+chat_states = BoundedLRU(maxsize=1024, ttl=3600)
+
+# Error keywords for failure detection, pre-encoded for bytes.find
+_ERROR_KEYWORDS = tuple(
+    k.encode("utf-8")
+    for k in ("错误", "失败", "bug", "error", "exception", "failed", "invalid", "cannot", "unable")
+)
+
+# Constant Bot API payload, serialized once
+_BOT_COMMANDS_BYTES = _json_dumps({"commands": Config.BOT_COMMANDS})
+
+# Memory/failure DB writes run here so they never delay the Telegram reply
+memory_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="memory")
 
 # Function aliases for backward compatibility
 def tmux_exists() -> bool:
@@ -123,11 +235,9 @@ def tmux_send_escape() -> None:
     """Send Escape key to tmux."""
     TmuxManager.send_escape()
 
-def send_typing_loop(chat_id: int) -> None:
-    """Send typing action in a loop."""
-    while os.path.exists(Config.PENDING_FILE):
-        TelegramAPI.send_typing(chat_id)
-        time.sleep(5)
+def tmux_send_line(text: str) -> None:
+    """Send literal text plus Enter to tmux in one call."""
+    TmuxManager.send_line(text)
 
 def get_updates(offset: Optional[int] = None) -> Optional[Dict]:
     """Fetch updates from Telegram."""
@@ -141,22 +251,56 @@ def setup_bot_commands() -> None:
 class TelegramAPI:
     """Telegram Bot API wrapper."""
 
+    HOST = "api.telegram.org"
+    _local = threading.local()  # One keep-alive HTTPS connection per thread
+
+    @staticmethod
+    def _connection(timeout: float) -> http.client.HTTPSConnection:
+        """Return this thread's persistent connection to the Bot API."""
+        conn = getattr(TelegramAPI._local, "conn", None)
+        if conn is None:
+            conn = http.client.HTTPSConnection(TelegramAPI.HOST, timeout=timeout)
+            TelegramAPI._local.conn = conn
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn
+
+    @staticmethod
+    def _request(method: str, data: Optional[Dict] = None, timeout: float = 30,
+                 raw: Optional[bytes] = None) -> Dict:
+        """Send one Bot API request; network errors and timeouts propagate.
+
+        ``raw`` is an already serialized JSON body and takes precedence over ``data``.
+        """
+        path = f"/bot{Config.BOT_TOKEN}/{method}"
+        body = raw if raw is not None else (_json_dumps(data) if data else None)
+        headers = {"Content-Type": "application/json"}
+        for attempt in range(2):
+            conn = TelegramAPI._connection(timeout)
+            try:
+                conn.request("POST", path, body=body, headers=headers)
+                with conn.getresponse() as r:
+                    return _json_loads(r.read())
+            except (http.client.HTTPException, ConnectionError):
+                # Server dropped the idle keep-alive connection; reconnect once
+                conn.close()
+                if attempt:
+                    raise
+            except Exception:
+                conn.close()
+                raise
+
     @staticmethod
-    def call(method: str, data: Optional[Dict] = None) -> Optional[Dict]:
+    def call(method: str, data: Optional[Dict] = None, timeout: float = 30,
+             raw: Optional[bytes] = None) -> Optional[Dict]:
         """Make a request to the Telegram Bot API."""
         if not Config.BOT_TOKEN:
             print("Error: TELEGRAM_BOT_TOKEN not set")
             return None
 
-        url = f"https://api.telegram.org/bot{Config.BOT_TOKEN}/{method}"
-        req = urllib.request.Request(
-            url,
-            data=json.dumps(data).encode() if data else None,
-            headers={"Content-Type": "application/json"}
-        )
         try:
-            with urllib.request.urlopen(req, timeout=30) as r:
-                return json.loads(r.read())
+            return TelegramAPI._request(method, data, timeout, raw)
         except Exception as e:
             print(f"Telegram API error: {e}")
             return None
@@ -164,15 +308,27 @@ class TelegramAPI:
     @staticmethod
     def get_updates(offset: Optional[int] = None) -> Optional[Dict]:
         """Fetch updates from Telegram."""
-        data = {"timeout": 30}
+        if not Config.BOT_TOKEN:
+            print("Error: TELEGRAM_BOT_TOKEN not set")
+            return None
+
+        # 25s long poll under a 40s socket timeout; only the update types we handle
+        data = {"timeout": 25, "allowed_updates": ["message", "callback_query"], "limit": 100}
         if offset:
             data["offset"] = offset
-        return TelegramAPI.call("getUpdates", data)
+        try:
+            return TelegramAPI._request("getUpdates", data, timeout=40)
+        except TimeoutError:
+            # An idle long poll timing out is normal; poll again straight away
+            return {"ok": True, "result": []}
+        except Exception as e:
+            print(f"Telegram API error: {e}")
+            return None
 
     @staticmethod
     def setup_bot_commands() -> None:
         """Register bot commands with Telegram."""
-        result = TelegramAPI.call("setMyCommands", {"commands": Config.BOT_COMMANDS})
+        result = TelegramAPI.call("setMyCommands", raw=_BOT_COMMANDS_BYTES)
         if result and result.get("ok"):
             print("Bot commands registered")
 
@@ -181,37 +337,94 @@ class TelegramAPI:
         """Send typing action."""
         TelegramAPI.call("sendChatAction", {"chat_id": chat_id, "action": "typing"})
 
+    # Telegram has a 4096 character limit per message; leave some margin
+    MAX_MESSAGE_LENGTH = 4000
+    _FENCE_CLOSE = "\n```"  # Appended to a chunk that ends inside a code block
+
+    @staticmethod
+    def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+        """Split text into chunks of at most ``limit`` characters.
+
+        Breaks on paragraphs first, then lines, and hard-wraps only lines that
+        are longer than a whole chunk. A code fence still open at a chunk
+        boundary is closed there and reopened at the start of the next chunk.
+        """
+        if len(text) <= limit:
+            return [text]
+
+        close = TelegramAPI._FENCE_CLOSE
+        units = []  # (separator, segment) pairs; separator "" marks a hard-wrap continuation
+        for para in text.split("\n\n"):
+            if len(para) <= limit - len(close):
+                units.append(("\n\n", para))
+                continue
+            sep = "\n\n"
+            for line in para.split("\n"):
+                units.append((sep, line))
+                sep = "\n"
+        units.reverse()
+
+        chunks = []  # (reopened fence, body, fence still open at the end)
+        opened = fence = None
+        current = ""
+        while units:
+            sep, segment = units.pop()
+            # Room left for the body once the reopened fence line and a closing fence are added
+            room = max(1, limit - len(close) - (len(opened) + 1 if opened else 0))
+            if current and len(current) + len(sep) + len(segment) > room:
+                chunks.append((opened, current, fence))
+                # An info string too long to repeat is dropped rather than starving the chunk
+                opened = fence if not fence or len(fence) <= limit // 4 else "```"
+                current = ""
+                units.append((sep, segment))
+                continue
+            if len(segment) > room:
+                if "\n" in segment:
+                    # A paragraph that no longer fits is split into lines first
+                    lines = segment.split("\n")
+                    units.extend(("\n", line) for line in reversed(lines[1:]))
+                    units.append((sep, lines[0]))
+                    continue
+                units.append(("", segment[room:]))
+                segment = segment[:room]
+            lines = segment.split("\n")
+            for line in lines[1:] if sep == "" else lines:
+                if line.lstrip().startswith("```"):
+                    fence = None if fence else line.strip()
+            current = current + sep + segment if current else segment
+        if current:
+            chunks.append((opened, current, fence))
+
+        return [
+            (f"{opened}\n" if opened else "") + body + (close if still_open else "")
+            for opened, body, still_open in chunks
+        ]
+
+    @staticmethod
+    def _send_text(chat_id: int, text: str) -> bool:
+        """Send one message, halving it if Telegram still says it is too long."""
+        result = TelegramAPI.call("sendMessage", {"chat_id": chat_id, "text": text})
+        if result is not None and result.get("ok", False):
+            return True
+        too_long = result is not None and "too long" in result.get("description", "").lower()
+        if not too_long or len(text) < 2:
+            return False
+        return all(
+            TelegramAPI._send_text(chat_id, part)
+            for part in TelegramAPI.split_message(text, len(text) // 2)
+        )
+
     @staticmethod
     def reply(chat_id: int, text: str) -> bool:
         """Send a text message to a chat. Returns True on success, False on failure."""
-        # Telegram has a 4096 character limit per message
-        MAX_LENGTH = 4000  # Leave some margin
-
-        if len(text) <= MAX_LENGTH:
-            result = TelegramAPI.call("sendMessage", {"chat_id": chat_id, "text": text})
-            return result is not None and result.get("ok", False)
-
-        # Split long messages into chunks
-        chunks = []
-        current_chunk = ""
-
-        for line in text.split('\n'):
-            if len(current_chunk) + len(line) + 1 > MAX_LENGTH:
-                if current_chunk:
-                    chunks.append(current_chunk)
-                current_chunk = line
-            else:
-                current_chunk += '\n' + line if current_chunk else line
-
-        if current_chunk:
-            chunks.append(current_chunk)
+        chunks = TelegramAPI.split_message(text)
+        if len(chunks) == 1:
+            return TelegramAPI._send_text(chat_id, text)
 
         # Send chunks
         all_success = True
         for i, chunk in enumerate(chunks):
-            prefix = f"[{i+1}/{len(chunks)}] " if len(chunks) > 1 else ""
-            result = TelegramAPI.call("sendMessage", {"chat_id": chat_id, "text": prefix + chunk})
-            if result is None or not result.get("ok", False):
+            if not TelegramAPI._send_text(chat_id, f"[{i+1}/{len(chunks)}] {chunk}"):
                 all_success = False
 
         return all_success
@@ -228,15 +441,28 @@ class TmuxManager:
             capture_output=True
         ).returncode == 0
 
+    @staticmethod
+    def _escape(text: str) -> str:
+        """Protect a trailing ';', which tmux would parse as a command separator."""
+        return text[:-1] + "\\;" if text.endswith(";") else text
+
     @staticmethod
     def send(text: str, literal: bool = True) -> None:
         """Send text to tmux session."""
         cmd = ["tmux", "send-keys", "-t", Config.TMUX_SESSION]
         if literal:
             cmd.append("-l")
-        cmd.append(text)
+        cmd.append(TmuxManager._escape(text))
         subprocess.run(cmd)
 
+    @staticmethod
+    def send_line(text: str) -> None:
+        """Send literal text followed by Enter in one tmux call."""
+        subprocess.run([
+            "tmux", "send-keys", "-t", Config.TMUX_SESSION, "-l", TmuxManager._escape(text),
+            ";", "send-keys", "-t", Config.TMUX_SESSION, "Enter",
+        ])
+
     @staticmethod
     def send_enter() -> None:
         """Send Enter key to tmux."""
@@ -248,15 +474,72 @@ class TmuxManager:
         subprocess.run(["tmux", "send-keys", "-t", Config.TMUX_SESSION, "Escape"])
 
 
+class TypingScheduler:
+    """Send typing actions for every waiting chat from a single thread.
+
+    Chats are added when a request goes to Claude and removed once the
+    reply is sent; the worker exits when nothing is pending, and also
+    stops as soon as PENDING_FILE disappears.
+    """
+
+    INTERVAL = 4.0  # Telegram shows "typing" for ~5s per action
+
+    def __init__(self):
+        self.pending: set[int] = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, chat_id: int) -> None:
+        """Start showing typing for a chat."""
+        with self._lock:
+            self.pending.add(chat_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def remove(self, chat_id: int) -> None:
+        """Stop showing typing for a chat."""
+        with self._lock:
+            self.pending.discard(chat_id)
+
+    def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            with self._lock:
+                if not os.path.exists(Config.PENDING_FILE):
+                    self.pending.clear()
+                if not self.pending:
+                    self._thread = None
+                    return
+                chats = list(self.pending)
+            for chat_id in chats:
+                TelegramAPI.send_typing(chat_id)
+            self._wake.wait(self.INTERVAL)
+
+
+typing_scheduler = TypingScheduler()
+
+
+@functools.lru_cache(maxsize=1)
+def _read_claude_md(path: str, mtime_ns: int) -> str:
+    """Read .CLAUDE.md; cached per (path, mtime) so edits invalidate it."""
+    return Path(path).read_text(encoding="utf-8")
+
+
 def load_claude_md() -> str:
     """Load .CLAUDE.md from project or home directory."""
     paths = [Path(".CLAUDE.md"), Path.home() / ".claude" / ".CLAUDE.md"]
     for path in paths:
-        if path.exists():
-            try:
-                return path.read_text(encoding="utf-8")
-            except Exception as e:
-                print(f"Error reading {path}: {e}")
+        try:
+            mtime_ns = path.stat().st_mtime_ns
+        except OSError:
+            continue
+        try:
+            return _read_claude_md(str(path), mtime_ns)
+        except Exception as e:
+            print(f"Error reading {path}: {e}")
     return ""
 
 
@@ -324,28 +607,47 @@ def extract_memory_update(response: str) -> tuple[str, str]:
     return cleaned_response, memory_content
 
 
+# (HISTORY_FILE mtime_ns, limit, sessions) from the last read
+_recent_sessions_cache: tuple = (None, None, [])
+SESSION_CACHE_TTL = 30  # seconds a project's session ID lookup is reused
+HISTORY_TAIL_LINES = 256  # trailing history.jsonl lines scanned for recent sessions
+
+
 def get_recent_sessions(limit=5):
-    """Get list of recent Claude sessions."""
-    if not os.path.exists(Config.HISTORY_FILE):
+    """Get list of recent Claude sessions (cached until HISTORY_FILE changes)."""
+    global _recent_sessions_cache
+    try:
+        mtime_ns = os.stat(Config.HISTORY_FILE).st_mtime_ns
+    except OSError:
         return []
 
+    cached_mtime, cached_limit, cached = _recent_sessions_cache
+    if cached_mtime == mtime_ns and cached_limit == limit:
+        return cached
+
+    # history.jsonl is append-only, so the newest sessions are in its tail;
+    # only those lines are kept and decoded
     sessions = []
     try:
         with open(Config.HISTORY_FILE) as f:
-            for line in f:
-                try:
-                    sessions.append(json.loads(line.strip()))
-                except:
-                    continue
+            tail = deque(f, maxlen=max(HISTORY_TAIL_LINES, limit * 4))
     except:
         return []
 
+    for line in tail:
+        try:
+            sessions.append(json.loads(line.strip()))
+        except:
+            continue
+
     sessions.sort(key=lambda x: x.get("timestamp", 0), reverse=True)
-    return sessions[:limit]
+    sessions = sessions[:limit]
+    _recent_sessions_cache = (mtime_ns, limit, sessions)
+    return sessions
 
 
-def get_session_id(project_path):
-    """Get session ID from project path."""
+@functools.lru_cache(maxsize=256)
+def _get_session_id_cached(project_path, ttl_bucket):
     encoded = project_path.replace("/", "-").lstrip("-")
     for prefix in [f"-{encoded}", encoded]:
         project_dir = Path.home() / ".claude" / "projects" / prefix
@@ -356,16 +658,58 @@ def get_session_id(project_path):
     return None
 
 
+def get_session_id(project_path):
+    """Get session ID from project path (memoized for SESSION_CACHE_TTL)."""
+    return _get_session_id_cached(project_path, int(time.monotonic() // SESSION_CACHE_TTL))
+
+
+def clear_session_caches():
+    """Forget cached session lookups, e.g. after /clear starts a new session."""
+    global _recent_sessions_cache
+    _recent_sessions_cache = (None, None, [])
+    _get_session_id_cached.cache_clear()
+
+
+# (directory mtimes, latest path, monotonic time of the scan)
+_latest_transcript_cache: tuple = ((), None, 0.0)
+TRANSCRIPT_RESCAN_INTERVAL = 1.0
+
+
+def _transcript_dirs_signature() -> tuple:
+    """mtime_ns of each transcript directory (changes when files are added)."""
+    sig = []
+    for path in Config.TRANSCRIPT_DIRS:
+        try:
+            sig.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            sig.append(None)
+    return tuple(sig)
+
+
 def find_latest_transcript():
-    """Find the most recent Claude transcript file."""
-    search_paths = [
-        Path.home() / ".claude" / "transcripts",
-        Path.home() / ".claude" / "projects",
-    ]
+    """Find the most recent Claude transcript file.
+
+    The glob + stat scan is reused while the transcript directories are
+    unchanged, and redone at least every TRANSCRIPT_RESCAN_INTERVAL seconds
+    to catch sessions appending to an older file.
+    """
+    global _latest_transcript_cache
+    sig = _transcript_dirs_signature()
+    cached_sig, cached_path, checked = _latest_transcript_cache
+    now = time.monotonic()
+    if cached_path is not None and sig == cached_sig and now - checked < TRANSCRIPT_RESCAN_INTERVAL:
+        return cached_path
+
+    latest = _scan_latest_transcript()
+    _latest_transcript_cache = (sig, latest, now)
+    return latest
+
 
+def _scan_latest_transcript():
+    """Glob all transcript directories for the newest .jsonl file."""
     all_transcripts = []
 
-    for path in search_paths:
+    for path in Config.TRANSCRIPT_DIRS:
         if not path.exists():
             continue
         if path.name == "projects":
@@ -394,163 +738,171 @@ def extract_assistant_responses(transcript_path, last_response_pos=0, seen_messa
         seen_message_ids = set()
 
     responses = []
-    current_pos = 0
+    current_pos = last_response_pos
     found_new_content = False
 
     try:
-        with open(transcript_path, 'r') as f:
-            lines = f.readlines()
+        with open(transcript_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size <= last_response_pos:
+                return "", last_response_pos, seen_message_ids
+
+            # Scan only the bytes after last_response_pos, straight from the page cache
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                while True:
+                    # A line without a newline is still being written; retry it next time
+                    line_end = mm.find(b"\n", current_pos)
+                    if line_end < 0:
+                        break
 
-        for line_idx, line in enumerate(lines):
-            line_start_pos = current_pos
-            current_pos += len(line)
+                    line_start_pos = current_pos
+                    current_pos = line_end + 1
 
-            # Skip lines we've already processed
-            if line_start_pos < last_response_pos:
-                continue
+                    # Most lines are user/tool records; only decode assistant ones
+                    if mm.find(b'"assistant"', line_start_pos, line_end) < 0:
+                        continue
 
-            # Also skip if we've seen this exact line position before
-            line_pos_key = f"{transcript_path}:{line_start_pos}"
-            if line_pos_key in seen_message_ids:
-                continue
+                    # Also skip if we've seen this exact line position before
+                    line_pos_key = f"{transcript_path}:{line_start_pos}"
+                    if line_pos_key in seen_message_ids:
+                        continue
 
-            try:
-                entry = json.loads(line.strip())
-                if entry.get("type") == "assistant":
-                    message = entry.get("message", {})
-
-                    # Extract text blocks from this line only
-                    text_content = []
-
-                    # Extract content from all block types
-                    content_blocks = message.get("content", [])
-                    if not isinstance(content_blocks, list):
-                        print(f"[DEBUG] Unexpected content type: {type(content_blocks)}")
-                        content_blocks = []
-
-                    for block in content_blocks:
-                        if not isinstance(block, dict):
-                            continue
-
-                        block_type = block.get("type")
-
-                        if block_type == "text":
-                            text = block.get("text", "").strip()
-                            # Skip XML observation blocks and empty text
-                            if not text:
-                                continue
-                            # Skip pure XML blocks (like <observation> or <memory>)
-                            # but allow text that happens to start with < (like code examples)
-                            if text.startswith("<") and text.endswith(">") and "/" in text[1:]:
-                                continue
-                            # Skip markdown XML code blocks only
-                            if text.startswith("```xml") or text.startswith("```\n<"):
-                                continue
-                            text_content.append(text)
-
-                        elif block_type == "thinking":
-                            # Skip thinking blocks - they are internal reasoning, not user-facing
-                            continue
-
-                        elif block_type == "tool_use":
-                            # Format tool_use as Markdown code block
-                            tool_name = block.get("name", "unknown_tool")
-                            tool_input = block.get("input", {})
-                            tool_id = block.get("id", "")
-                            try:
-                                input_str = json.dumps(tool_input, indent=2, ensure_ascii=False)
-                            except Exception:
-                                input_str = str(tool_input)
-                            tool_text = f"🔧 Tool Use: `{tool_name}` (ID: `{tool_id}`)\n\n```json\n{input_str}\n```"
-                            text_content.append(tool_text)
-
-                        elif block_type == "tool_result":
-                            # Format tool_result as Markdown code block
-                            tool_content = block.get("content", "")
-                            tool_use_id = block.get("tool_use_id", "")
-                            is_error = block.get("is_error", False)
-
-                            # Handle content that might be a list of blocks or a string
-                            if isinstance(tool_content, list):
-                                # Extract text from content blocks
-                                content_parts = []
-                                for item in tool_content:
-                                    if isinstance(item, dict):
-                                        if item.get("type") == "text":
-                                            content_parts.append(item.get("text", ""))
-                                        else:
-                                            content_parts.append(str(item))
+                    try:
+                        entry = _json_loads(mm[line_start_pos:line_end])
+                        if entry.get("type") == "assistant":
+                            message = entry.get("message", {})
+
+                            # Extract text blocks from this line only
+                            text_content = []
+
+                            # Extract content from all block types
+                            content_blocks = message.get("content", [])
+                            if not isinstance(content_blocks, list):
+                                logger.debug("Unexpected content type: %s", type(content_blocks))
+                                content_blocks = []
+
+                            for block in content_blocks:
+                                if not isinstance(block, dict):
+                                    continue
+
+                                block_type = block.get("type")
+
+                                if block_type == "text":
+                                    text = block.get("text", "").strip()
+                                    # Skip XML observation blocks and empty text
+                                    if not text:
+                                        continue
+                                    # Skip pure XML blocks (like <observation> or <memory>)
+                                    # but allow text that happens to start with < (like code examples)
+                                    if text.startswith("<") and text.endswith(">") and "/" in text[1:]:
+                                        continue
+                                    # Skip markdown XML code blocks only
+                                    if text.startswith("```xml") or text.startswith("```\n<"):
+                                        continue
+                                    text_content.append(text)
+
+                                elif block_type == "thinking":
+                                    # Skip thinking blocks - they are internal reasoning, not user-facing
+                                    continue
+
+                                elif block_type == "tool_use":
+                                    # Format tool_use as Markdown code block
+                                    tool_name = block.get("name", "unknown_tool")
+                                    tool_input = block.get("input", {})
+                                    tool_id = block.get("id", "")
+                                    try:
+                                        input_str = json.dumps(tool_input, indent=2, ensure_ascii=False)
+                                    except Exception:
+                                        input_str = str(tool_input)
+                                    tool_text = f"🔧 Tool Use: `{tool_name}` (ID: `{tool_id}`)\n\n```json\n{input_str}\n```"
+                                    text_content.append(tool_text)
+
+                                elif block_type == "tool_result":
+                                    # Format tool_result as Markdown code block
+                                    tool_content = block.get("content", "")
+                                    tool_use_id = block.get("tool_use_id", "")
+                                    is_error = block.get("is_error", False)
+
+                                    # Handle content that might be a list of blocks or a string
+                                    if isinstance(tool_content, list):
+                                        # Extract text from content blocks
+                                        content_parts = []
+                                        for item in tool_content:
+                                            if isinstance(item, dict):
+                                                if item.get("type") == "text":
+                                                    content_parts.append(item.get("text", ""))
+                                                else:
+                                                    content_parts.append(str(item))
+                                            else:
+                                                content_parts.append(str(item))
+                                        tool_content_str = "\n".join(content_parts)
+                                    elif isinstance(tool_content, str):
+                                        tool_content_str = tool_content
                                     else:
-                                        content_parts.append(str(item))
-                                tool_content_str = "\n".join(content_parts)
-                            elif isinstance(tool_content, str):
-                                tool_content_str = tool_content
-                            else:
-                                tool_content_str = str(tool_content)
-
-                            # Truncate very long content
-                            if len(tool_content_str) > 3000:
-                                tool_content_str = tool_content_str[:3000] + "\n\n... (truncated)"
-
-                            error_prefix = "❌ " if is_error else ""
-                            tool_text = f"{error_prefix}📤 Tool Result (ID: `{tool_use_id}`):\n\n```\n{tool_content_str}\n```"
-                            text_content.append(tool_text)
-
-                        elif block_type == "artifact":
-                            # Format artifact with metadata
-                            artifact_id = block.get("id", "")
-                            artifact_type = block.get("artifact_type", "")
-                            artifact_title = block.get("title", "")
-                            artifact_content = block.get("content", "")
-
-                            # Determine language hint from artifact type
-                            language_hint = ""
-                            if artifact_type == "application/vnd.chat.code":
-                                # Try to infer from title extension
-                                if artifact_title.endswith(".py"):
-                                    language_hint = "python"
-                                elif artifact_title.endswith((".js", ".ts")):
-                                    language_hint = "javascript"
-                                elif artifact_title.endswith(".html"):
-                                    language_hint = "html"
-                                elif artifact_title.endswith(".css"):
-                                    language_hint = "css"
-                                elif artifact_title.endswith(".json"):
-                                    language_hint = "json"
-                                elif artifact_title.endswith(".sh"):
-                                    language_hint = "bash"
-                                elif artifact_title.endswith((".yml", ".yaml")):
-                                    language_hint = "yaml"
-                            elif artifact_type == "text/markdown":
-                                language_hint = "markdown"
-                            elif artifact_type == "text/html":
-                                language_hint = "html"
-                            elif artifact_type == "image/svg+xml":
-                                language_hint = "svg"
-
-                            artifact_text = f"📄 Artifact: {artifact_title}\nType: `{artifact_type}` | ID: `{artifact_id}`\n\n```{language_hint}\n{artifact_content}\n```"
-                            text_content.append(artifact_text)
-
-                    # Mark this line as processed
-                    seen_message_ids.add(line_pos_key)
-
-                    # Add content from this line
-                    if text_content:
-                        full_text = "\n".join(text_content)
-                        responses.append(full_text)
-                        found_new_content = True
-
-            except (json.JSONDecodeError, KeyError):
-                # Skip malformed lines
-                continue
+                                        tool_content_str = str(tool_content)
+
+                                    # Truncate very long content
+                                    if len(tool_content_str) > 3000:
+                                        tool_content_str = tool_content_str[:3000] + "\n\n... (truncated)"
+
+                                    error_prefix = "❌ " if is_error else ""
+                                    tool_text = f"{error_prefix}📤 Tool Result (ID: `{tool_use_id}`):\n\n```\n{tool_content_str}\n```"
+                                    text_content.append(tool_text)
+
+                                elif block_type == "artifact":
+                                    # Format artifact with metadata
+                                    artifact_id = block.get("id", "")
+                                    artifact_type = block.get("artifact_type", "")
+                                    artifact_title = block.get("title", "")
+                                    artifact_content = block.get("content", "")
+
+                                    # Determine language hint from artifact type
+                                    language_hint = ""
+                                    if artifact_type == "application/vnd.chat.code":
+                                        # Try to infer from title extension
+                                        if artifact_title.endswith(".py"):
+                                            language_hint = "python"
+                                        elif artifact_title.endswith((".js", ".ts")):
+                                            language_hint = "javascript"
+                                        elif artifact_title.endswith(".html"):
+                                            language_hint = "html"
+                                        elif artifact_title.endswith(".css"):
+                                            language_hint = "css"
+                                        elif artifact_title.endswith(".json"):
+                                            language_hint = "json"
+                                        elif artifact_title.endswith(".sh"):
+                                            language_hint = "bash"
+                                        elif artifact_title.endswith((".yml", ".yaml")):
+                                            language_hint = "yaml"
+                                    elif artifact_type == "text/markdown":
+                                        language_hint = "markdown"
+                                    elif artifact_type == "text/html":
+                                        language_hint = "html"
+                                    elif artifact_type == "image/svg+xml":
+                                        language_hint = "svg"
+
+                                    artifact_text = f"📄 Artifact: {artifact_title}\nType: `{artifact_type}` | ID: `{artifact_id}`\n\n```{language_hint}\n{artifact_content}\n```"
+                                    text_content.append(artifact_text)
+
+                            # Mark this line as processed
+                            seen_message_ids.add(line_pos_key)
+
+                            # Add content from this line
+                            if text_content:
+                                full_text = "\n".join(text_content)
+                                responses.append(full_text)
+                                found_new_content = True
+
+                    except (ValueError, KeyError):
+                        # Skip malformed lines
+                        continue
 
     except Exception as e:
         print(f"Error reading transcript: {e}")
         return "", last_response_pos, seen_message_ids
 
-    # 如果没有找到新内容，保持原位置不变
+    # 没有新文本也推进到最后一个完整行之后，已读过的行不再重复解析
     if not found_new_content:
-        return "", last_response_pos, seen_message_ids
+        return "", current_pos, seen_message_ids
 
     return "\n\n".join(responses).strip(), current_pos, seen_message_ids
 
@@ -584,12 +936,15 @@ class ResponseMonitor:
         self._checking = False
         self._seen_message_ids = set()  # Track processed message IDs for current file
         self._file_states = {}  # Track read positions per transcript file: {path: {'position': int, 'seen_ids': set}}
+        self._request_sent = threading.Event()  # Set when a prompt is sent to Claude
+        self._stop = threading.Event()  # Stops the watchfiles loop
 
     def start(self):
         """Start the response monitor with file watching."""
         if self.running:
             return
         self.running = True
+        self._stop.clear()
 
         # Start file watcher for immediate response detection
         self._start_file_watcher()
@@ -599,15 +954,18 @@ class ResponseMonitor:
         self.monitor_thread.start()
         print("Response monitor started with file watching")
 
+    def notify_request(self):
+        """Wake the file watcher right after a prompt has been sent to Claude."""
+        self._request_sent.set()
+
     def _start_file_watcher(self):
         """Start watching for transcript file updates using polling."""
         def file_watcher():
             last_transcript_mtime = 0
             pending_existed = False
+            delay = 0.05
             while self.running:
                 try:
-                    current_time = time.time()
-
                     # Check if pending file exists (indicates active request)
                     if os.path.exists(Config.PENDING_FILE):
                         # Find latest transcript and check its modification time
@@ -616,43 +974,64 @@ class ResponseMonitor:
                             mtime = transcript_path.stat().st_mtime
                             # Trigger check if transcript is new or modified
                             if mtime > last_transcript_mtime or not pending_existed:
-                                print(f"[DEBUG] File watcher detected transcript update")
+                                logger.debug("File watcher detected transcript update")
                                 self._immediate_response_check()
                                 last_transcript_mtime = mtime
+                                delay = 0.05
                         pending_existed = True
+                        # 无更新时指数退避，新请求发出时立即唤醒
+                        timeout = delay
+                        delay = min(0.5, delay * 1.5)
                     else:
                         # Reset when request is complete
                         pending_existed = False
                         last_transcript_mtime = 0
+                        timeout = 1.0
 
-                    time.sleep(0.05)  # 50ms polling interval
+                    if self._request_sent.wait(timeout):
+                        self._request_sent.clear()
+                        delay = 0.05
                 except Exception as e:
-                    print(f"[DEBUG] File watcher error: {e}")
+                    logger.debug("File watcher error: %s", e)
                     time.sleep(0.1)
 
         watcher_thread = threading.Thread(target=file_watcher, daemon=True)
         watcher_thread.start()
-        print(f"[DEBUG] File watcher started polling for transcript updates")
+        logger.debug("File watcher started polling for transcript updates")
 
     def _immediate_response_check(self):
         """Immediate response check when pending file is detected."""
         try:
             # Wait a tiny bit for file to be fully written
             time.sleep(0.05)
-            print(f"[DEBUG] Immediate response check triggered")
+            logger.debug("Immediate response check triggered")
             self._check_for_responses()
         except Exception as e:
-            print(f"[DEBUG] Immediate response check error: {e}")
+            logger.debug("Immediate response check error: %s", e)
 
     def _monitor_loop(self):
         """Main monitoring loop."""
+        watch_dirs = [p for p in Config.TRANSCRIPT_DIRS if p.exists()]
+        if watch is not None and watch_dirs:
+            # Block on inotify events; the 1s timeout still runs a periodic check
+            for _ in watch(*watch_dirs, stop_event=self._stop, rust_timeout=1000,
+                           yield_on_timeout=True, debounce=int(self.check_interval * 1000)):
+                if not self.running:
+                    break
+                self._safe_check()
+            return
+
         while self.running:
-            try:
-                self._check_for_responses()
-            except Exception as e:
-                print(f"Response monitor error: {e}")
+            self._safe_check()
             time.sleep(self.check_interval)
 
+    def _safe_check(self):
+        """Run one response check, logging instead of raising."""
+        try:
+            self._check_for_responses()
+        except Exception as e:
+            print(f"Response monitor error: {e}")
+
     def _check_for_responses(self):
         """Check for new assistant responses and send to Telegram."""
         pending_exists = os.path.exists(Config.PENDING_FILE)
@@ -668,7 +1047,7 @@ class ResponseMonitor:
                 )
                 if responses:
                     # 还有未发送的响应，继续发送
-                    print(f"[DEBUG] Found pending response after pending file removed")
+                    logger.debug("Found pending response after pending file removed")
                     self._process_responses(transcript_path, responses, new_position)
                     return
             # 确实没有待发送内容，重置状态
@@ -677,11 +1056,11 @@ class ResponseMonitor:
             self._seen_message_ids.clear()
             return
         else:
-            print(f"[DEBUG] Response monitor found pending file, checking for responses...")
+            logger.debug("Response monitor found pending file, checking for responses...")
 
         # 添加锁机制，避免并发检查
         if hasattr(self, '_checking') and self._checking:
-            print(f"[DEBUG] Already checking responses, skipping")
+            logger.debug("Already checking responses, skipping")
             return
 
         self._checking = True
@@ -706,19 +1085,20 @@ class ResponseMonitor:
                     saved_state = self._file_states[self.last_transcript_path]
                     self.last_position = saved_state['position']
                     self._seen_message_ids = saved_state['seen_ids'].copy()
-                    print(f"[DEBUG] Restored state for {transcript_path.name}: pos={self.last_position}")
+                    logger.debug("Restored state for %s: pos=%s", transcript_path.name, self.last_position)
                 else:
                     # 新文件，从头开始
                     self.last_position = 0
                     self._seen_message_ids.clear()
-                    print(f"[DEBUG] New transcript file: {transcript_path.name}")
+                    logger.debug("New transcript file: %s", transcript_path.name)
 
             # 使用增量读取，从上次位置开始读取新内容
             responses, new_position, self._seen_message_ids = extract_assistant_responses(
                 transcript_path, self.last_position, self._seen_message_ids
             )
 
-            print(f"[DEBUG] extract_assistant_responses: responses_len={len(responses)}, new_pos={new_position}, seen_ids={len(self._seen_message_ids)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("extract_assistant_responses: responses_len=%s, new_pos=%s, seen_ids=%s", len(responses), new_position, len(self._seen_message_ids))
 
             # 即使没有找到文本响应，也要更新位置（可能已经处理了工具调用）
             self.last_position = new_position
@@ -748,7 +1128,7 @@ class ResponseMonitor:
                     pass
                 if time.time() - pending_time > 600:  # 10 minutes
                     os.remove(Config.PENDING_FILE)
-                    print(f"[DEBUG] Pending file removed after 10min timeout")
+                    logger.debug("Pending file removed after 10min timeout")
         finally:
             # 释放锁
             self._checking = False
@@ -756,12 +1136,13 @@ class ResponseMonitor:
     def stop(self):
         """Stop the response monitor."""
         self.running = False
+        self._stop.set()
         if self.observer:
             try:
                 self.observer.stop()
                 self.observer.join()
             except Exception as e:
-                print(f"[DEBUG] Error stopping observer: {e}")
+                logger.debug("Error stopping observer: %s", e)
         if self.monitor_thread:
             self.monitor_thread.join(timeout=1)
         print("Response monitor stopped")
@@ -769,43 +1150,51 @@ class ResponseMonitor:
     def _process_responses(self, transcript_path, responses, new_position):
         """Process and send responses to Telegram."""
         if not os.path.exists(Config.CHAT_ID_FILE):
-            print(f"[DEBUG] CHAT_ID_FILE not found: {Config.CHAT_ID_FILE}")
+            logger.debug("CHAT_ID_FILE not found: %s", Config.CHAT_ID_FILE)
             return
 
         with open(Config.CHAT_ID_FILE) as f:
             chat_id = int(f.read().strip())
 
-        print(f"[DEBUG] Processing responses for chat {chat_id}, raw length={len(responses)}")
-        print(f"[DEBUG] Raw responses preview: {responses[:200]}...")
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("Processing responses for chat %s, raw length=%s", chat_id, len(responses))
+            logger.debug("Raw responses preview: %.200s...", responses)
 
         cleaned_responses, memory_update = extract_memory_update(responses)
 
-        print(f"[DEBUG] Cleaned responses length={len(cleaned_responses)}, memory length={len(memory_update)}")
+        if debug:
+            logger.debug("Cleaned responses length=%s, memory length=%s", len(cleaned_responses), len(memory_update))
 
         # Skip empty responses (e.g., when only XML observations were present)
         if not cleaned_responses or not cleaned_responses.strip():
-            print(f"[DEBUG] Skipping empty response for chat {chat_id}")
+            logger.debug("Skipping empty response for chat %s", chat_id)
             # 空响应也清理pending文件，避免卡住
             if os.path.exists(Config.PENDING_FILE):
                 os.remove(Config.PENDING_FILE)
-                print(f"[DEBUG] Pending file removed for empty response")
+                logger.debug("Pending file removed for empty response")
             return
 
-        # 先保存到内存，再发送消息
-        self._save_to_memory(chat_id, cleaned_responses, memory_update)
+        # 后台保存到内存，与发送消息并行
+        # The question is taken now, before a newer message can replace the chat's state
+        if Config.MEMORY_ENABLED:
+            state = chat_states.pop(str(chat_id))
+            user_msg = state.last_msg if state else ""
+            memory_executor.submit(self._save_to_memory, chat_id, user_msg, cleaned_responses, memory_update)
 
         # 发送消息到Telegram
         result = reply(chat_id, cleaned_responses)
         if result is not False:
-            print(f"[DEBUG] Response sent to chat {chat_id}")
+            typing_scheduler.remove(chat_id)
+            logger.debug("Response sent to chat %s", chat_id)
             # 只有在成功发送响应后才移除pending文件
             if os.path.exists(Config.PENDING_FILE):
                 os.remove(Config.PENDING_FILE)
-                print(f"[DEBUG] Pending file removed after sending response")
+                logger.debug("Pending file removed after sending response")
         else:
-            print(f"[DEBUG] Failed to send response, keeping pending file for retry")
+            logger.debug("Failed to send response, keeping pending file for retry")
 
-    def _save_to_memory(self, chat_id, cleaned_responses, memory_update):
+    def _save_to_memory(self, chat_id, user_msg, cleaned_responses, memory_update):
         """Save conversation to memory."""
         if not Config.MEMORY_ENABLED:
             return
@@ -814,15 +1203,12 @@ class ResponseMonitor:
             memory = get_memory()
             chat_id_str = str(chat_id)
 
-            if chat_id_str in recent_messages:
-                user_msg = recent_messages[chat_id_str]
+            if user_msg:
                 memory.add(
                     chat_id_str,
                     f"Q: {user_msg}\nA: {cleaned_responses[:2000]}",
                     metadata={"type": "conversation"}
                 )
-                recent_messages.pop(chat_id_str, None)
-                recent_full_prompts.pop(chat_id_str, None)
 
             if memory_update:
                 memory.add(
@@ -833,46 +1219,40 @@ class ResponseMonitor:
                 )
 
             # Record failures if lesson extracted or error detected
-            self._record_failures_if_any(chat_id_str, cleaned_responses)
+            self._record_failures_if_any(chat_id_str, cleaned_responses, user_msg)
 
         except Exception as e:
             print(f"Error saving to memory: {e}")
 
-    def _record_failures_if_any(self, chat_id_str: str, response: str):
+    def _record_failures_if_any(self, chat_id_str: str, response: str, user_msg: str):
         """记录失败经验（如果响应中包含教训或错误）"""
         try:
-            failure_memory = get_failure_memory()
-
-            # 获取用户输入（如果有）
-            user_msg = recent_messages.get(chat_id_str)
+            # 没有对应的用户输入则无需记录
             if not user_msg:
                 return
 
-            # 尝试提取教训
+            failure_memory = get_failure_memory()
+
+            # 尝试提取教训；没有明确教训但检测到错误关键词时也记录
             lesson = failure_memory.extract_lesson_from_response(response)
             if lesson:
-                # 记录失败，用户输入作为 action，response 作为 error_message
-                failure_memory.record_failure(
-                    user_id=chat_id_str,
-                    action=user_msg[:100],  # 截取前100字符作为action
-                    error_message=response[:500],  # 截取前500字符作为错误信息
-                    context=f"用户输入: {user_msg[:200]}",
-                    lesson=lesson
-                )
-                print(f"Recorded failure lesson for user {chat_id_str}")
-                return
-
-            # 如果没有明确教训，但检测到错误关键词，也记录
-            error_keywords = ["错误", "失败", "bug", "error", "exception", "failed", "invalid", "cannot", "unable"]
-            if any(keyword in response.lower() for keyword in error_keywords):
-                failure_memory.record_failure(
-                    user_id=chat_id_str,
-                    action=user_msg[:100],
-                    error_message=response[:500],
-                    context=f"用户输入: {user_msg[:200]}",
-                    lesson="检测到错误关键词，建议手动总结教训"
-                )
-                print(f"Recorded failure based on error keywords for user {chat_id_str}")
+                log_msg = f"Recorded failure lesson for user {chat_id_str}"
+            else:
+                lowered = response.lower().encode("utf-8")
+                if not any(lowered.find(keyword) >= 0 for keyword in _ERROR_KEYWORDS):
+                    return
+                lesson = "检测到错误关键词，建议手动总结教训"
+                log_msg = f"Recorded failure based on error keywords for user {chat_id_str}"
+
+            # 用户输入作为 action，response 作为 error_message（各截取一次）
+            failure_memory.record_failure(
+                user_id=chat_id_str,
+                action=user_msg[:100],
+                error_message=response[:500],
+                context=f"用户输入: {user_msg[:200]}",
+                lesson=lesson
+            )
+            print(log_msg)
 
         except Exception as e:
             print(f"Error recording failure: {e}")
@@ -885,14 +1265,17 @@ class MessageQueue:
     """Ensure messages are processed in order."""
 
     def __init__(self):
-        self.queue = queue.Queue()
+        self.queue = deque()
         self.processing = False
         self.lock = threading.Lock()
+        self._not_empty = threading.Condition(self.lock)
+        self._chat_id = None  # Chat last written to CHAT_ID_FILE
 
     def add_message(self, chat_id, text, full_prompt):
         """Add a message to the queue."""
         with self.lock:
-            self.queue.put((chat_id, text, full_prompt))
+            self.queue.append((chat_id, text, full_prompt))
+            self._not_empty.notify()
             if not self.processing:
                 self.processing = True
                 threading.Thread(target=self._process_queue, daemon=True).start()
@@ -901,43 +1284,56 @@ class MessageQueue:
         """Process messages in the queue."""
         while True:
             try:
-                # 等待新消息，超时1秒
-                chat_id, text, full_prompt = self.queue.get(timeout=1)
-
-                # 检查是否有更新的消息在等待
-                while not self.queue.empty():
-                    try:
-                        # 尝试获取更新的消息（非阻塞）
-                        chat_id, text, full_prompt = self.queue.get_nowait()
-                    except queue.Empty:
+                with self.lock:
+                    # 等待新消息，超时1秒
+                    if not self.queue:
+                        self._not_empty.wait(timeout=1)
+                    if not self.queue:
+                        # 队列为空，退出处理循环
+                        self.processing = False
                         break
+                    # 一次性取出全部待处理消息，只保留最新的一条
+                    chat_id, text, full_prompt = self.queue[-1]
+                    self.queue.clear()
 
                 # 处理最新的消息
                 self._handle_message(chat_id, text, full_prompt)
 
-            except queue.Empty:
-                # 队列为空，退出处理循环
-                with self.lock:
-                    self.processing = False
-                break
             except Exception as e:
                 print(f"Error processing message queue: {e}")
 
+    def _save_chat_id(self, chat_id):
+        """Record the chat of the request being sent (atomically, via rename).
+
+        Only the single queue thread calls this, right before the pending
+        marker is created, so the response goes to the chat that sent the
+        prompt rather than whichever chat's handler ran last.
+        """
+        if chat_id == self._chat_id:
+            return
+        tmp = f"{Config.CHAT_ID_FILE}.tmp"
+        with open(tmp, "w") as f:
+            f.write(str(chat_id))
+        os.replace(tmp, Config.CHAT_ID_FILE)
+        self._chat_id = chat_id
+
     def _handle_message(self, chat_id, text, full_prompt):
         """Handle a single message."""
         try:
             # 存储消息用于跟踪和记忆
-            recent_messages[str(chat_id)] = text
-            recent_full_prompts[str(chat_id)] = full_prompt
+            chat_states[str(chat_id)] = ChatState(last_msg=text, last_prompt=full_prompt)
 
             # 确保目录存在
             Config.PENDING_FILE.parent.mkdir(parents=True, exist_ok=True)
 
+            # 记录本次请求所属的聊天，再创建pending文件
+            self._save_chat_id(chat_id)
+
             # 创建pending文件
             with open(Config.PENDING_FILE, "w") as f:
                 f.write(str(int(time.time())))
 
-            print(f"[DEBUG] Message queued and processing started for chat_id={chat_id}")
+            logger.debug("Message queued and processing started for chat_id=%s", chat_id)
 
             # 检查tmux是否存在
             if not tmux_exists():
@@ -947,13 +1343,13 @@ class MessageQueue:
                 return
 
             # 启动输入指示器
-            threading.Thread(target=send_typing_loop, args=(chat_id,), daemon=True).start()
+            typing_scheduler.add(chat_id)
 
             # 发送到tmux
-            tmux_send(full_prompt)
-            tmux_send_enter()
+            tmux_send_line(full_prompt)
+            response_monitor.notify_request()
 
-            print(f"[DEBUG] Message sent to tmux, response_monitor will handle the response asynchronously")
+            logger.debug("Message sent to tmux, response_monitor will handle the response asynchronously")
 
         except Exception as e:
             print(f"Error handling queued message: {e}")
@@ -969,9 +1365,39 @@ class BotHandler:
 
     def __init__(self):
         self.offset = self._load_offset()
+        Config.CLAUDE_DIR.mkdir(parents=True, exist_ok=True)
+        # Bounded handler concurrency; each chat's updates are drained in order by one worker
+        self.pool = ThreadPoolExecutor(max_workers=Config.HANDLER_WORKERS, thread_name_prefix="handler")
+        self._chat_queues: Dict[Any, deque] = {}  # Only chats with updates in flight
+        self._chat_queues_lock = threading.Lock()
         self._session_initialized = False
         self._attention_manager = AttentionManager()
         self._prompt_builder = StablePromptBuilder(self._attention_manager)
+        # Resolve the prompt path once instead of per message
+        self._build_prompt = (
+            self._build_raw_prompt if Config.TELEGRAM_RAW_MESSAGES else self._build_full_prompt
+        )
+        self._build_with_cache = self._attention_manager.build_optimized_prompt_with_cache
+        self._build_uncached = self._attention_manager.build_optimized_prompt
+        # Command dispatch table, built once
+        self._cmds = {
+            "/status": self._cmd_status,
+            "/stop": self._cmd_stop,
+            "/clear": self._cmd_clear,
+            "/continue_": self._cmd_continue,
+            "/resume": self._cmd_resume,
+            "/remember": self._cmd_remember,
+            "/recall": self._cmd_recall,
+            "/forget": self._cmd_forget,
+            "/memstats": self._cmd_memstats,
+            "/task": self._cmd_task,
+            "/todo": self._cmd_todo,
+            "/failures": self._cmd_failures,
+            "/lessons": self._cmd_lessons,
+            "/kvcache": self._cmd_kvcache,
+        }
+        # Warm the .CLAUDE.md cache so the first session skips the disk read
+        threading.Thread(target=load_claude_md, daemon=True).start()
 
     def _load_offset(self):
         """Load update offset from file."""
@@ -984,9 +1410,14 @@ class BotHandler:
         return 0
 
     def _save_offset(self, offset):
-        """Save update offset to file."""
-        with open(Config.UPDATE_OFFSET_FILE, "w") as f:
-            f.write(str(offset))
+        """Save update offset to file (atomically, via rename)."""
+        tmp = f"{Config.UPDATE_OFFSET_FILE}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, str(offset).encode())
+        finally:
+            os.close(fd)
+        os.replace(tmp, Config.UPDATE_OFFSET_FILE)
 
     def _require_tmux(self, chat_id):
         """Check if tmux exists, reply with error if not."""
@@ -999,7 +1430,7 @@ class BotHandler:
         """Start typing indicator."""
         with open(Config.PENDING_FILE, "w") as f:
             f.write(str(int(time.time())))
-        threading.Thread(target=send_typing_loop, args=(chat_id,), daemon=True).start()
+        typing_scheduler.add(chat_id)
 
     def _get_or_init_auto_memory_instruction(self) -> str:
         """Get auto-memory instruction from DB, initialize if not exists."""
@@ -1023,6 +1454,10 @@ class BotHandler:
             print(f"Error loading meta-instruction: {e}")
             return Config.DEFAULT_AUTO_MEMORY_INSTRUCTION
 
+    def _build_raw_prompt(self, text, chat_id, is_new_session=False):
+        """Send just the user's raw input without any wrappers."""
+        return text
+
     def _build_full_prompt(self, text, chat_id, is_new_session=False):
         """Build full prompt with AttentionManager for KV-Cache optimization.
 
@@ -1051,7 +1486,7 @@ class BotHandler:
         # Build optimized prompt using AttentionManager
         if Config.KV_CACHE_ENABLED:
             # Use KV-Cache enabled prompt builder
-            full_prompt, cache_info = self._attention_manager.build_optimized_prompt_with_cache(
+            result = self._build_with_cache(
                 user_input=text,
                 chat_id=str(chat_id),
                 memories=memories,
@@ -1059,12 +1494,12 @@ class BotHandler:
                 claude_md_content=claude_md_content,
                 ttl_seconds=Config.KV_CACHE_TTL,
             )
-            # Optionally log cache info for debugging
-            if cache_info.get("cache_hit"):
-                print(f"[KV-Cache] Hit for chat {chat_id}, key: {cache_info.get('cache_key', 'unknown')}")
+            full_prompt = result.prompt
+            if result.cache_hit:
+                logger.debug("[KV-Cache] Hit for chat %s, key: %s", chat_id, result.cache_key)
         else:
             # Original method (backward compatibility)
-            full_prompt = self._attention_manager.build_optimized_prompt(
+            full_prompt = self._build_uncached(
                 user_input=text,
                 chat_id=str(chat_id),
                 memories=memories,
@@ -1074,27 +1509,6 @@ class BotHandler:
 
         return full_prompt
 
-    def _wait_for_claude_response(self, timeout=30):
-        """Wait for Claude to generate a response with timeout."""
-        start_time = time.time()
-        check_count = 0
-
-        while time.time() - start_time < timeout:
-            # 检查是否已经有响应文件生成
-            transcript_path = find_latest_transcript()
-            if transcript_path and transcript_path.exists():
-                # 检查文件中是否有新的assistant响应（使用增量检查）
-                responses, _, _ = extract_assistant_responses(transcript_path, response_monitor.last_position, response_monitor._seen_message_ids)
-                if responses and responses.strip():
-                    print(f"[DEBUG] Found Claude response after {check_count} checks")
-                    return True
-
-            check_count += 1
-            time.sleep(0.1)  # 短间隔快速检查
-
-        print(f"[DEBUG] Timeout waiting for Claude response after {timeout}s")
-        return False
-
     def handle_message(self, msg):
         """Process incoming message from Telegram."""
         # Handle different message types
@@ -1102,7 +1516,7 @@ class BotHandler:
         chat_id = msg.get("chat", {}).get("id")
         msg_id = msg.get("message_id")
 
-        print(f"[DEBUG] Received message: chat_id={chat_id}, text='{text[:50]}...', msg_id={msg_id}")
+        logger.debug("Received message: chat_id=%s, text='%.50s...', msg_id=%s", chat_id, text, msg_id)
 
         if not chat_id:
             return
@@ -1150,7 +1564,7 @@ class BotHandler:
                 text = f"[Contact: {name.strip()}]"
             else:
                 # Unknown message type, skip processing
-                print(f"[DEBUG] Unknown message type, skipping: {msg.keys()}")
+                logger.debug("Unknown message type, skipping: %s", msg.keys())
                 return
 
         # Add caption if present (for media messages)
@@ -1158,21 +1572,13 @@ class BotHandler:
         if caption:
             text = f"{text}\n\nCaption: {caption}"
 
-        with open(Config.CHAT_ID_FILE, "w") as f:
-            f.write(str(chat_id))
-
         if text.startswith("/"):
             return self._handle_command(text, chat_id)
 
         print(f"[{chat_id}] {text[:50]}...")
 
-        # Send raw message if TELEGRAM_RAW_MESSAGES is enabled
-        if Config.TELEGRAM_RAW_MESSAGES:
-            # Send just the user's raw input without any wrappers
-            full_prompt = text
-        else:
-            # Use attention manager with all the wrappers
-            full_prompt = self._build_full_prompt(text, chat_id)
+        # Raw input or attention-manager wrapped, chosen in __init__
+        full_prompt = self._build_prompt(text, chat_id)
 
         # Store message ID for reaction
         if msg_id:
@@ -1191,25 +1597,9 @@ class BotHandler:
         cmd = parts[0].lower()
         args = parts[1] if len(parts) > 1 else ""
 
-        handlers = {
-            "/status": self._cmd_status,
-            "/stop": self._cmd_stop,
-            "/clear": self._cmd_clear,
-            "/continue_": self._cmd_continue,
-            "/resume": self._cmd_resume,
-            "/remember": self._cmd_remember,
-            "/recall": self._cmd_recall,
-            "/forget": self._cmd_forget,
-            "/memstats": self._cmd_memstats,
-            "/task": self._cmd_task,
-            "/todo": self._cmd_todo,
-            "/failures": self._cmd_failures,
-            "/lessons": self._cmd_lessons,
-            "/kvcache": self._cmd_kvcache,
-        }
-
-        if cmd in handlers:
-            handlers[cmd](chat_id, args)
+        handler = self._cmds.get(cmd)
+        if handler:
+            handler(chat_id, args)
         elif cmd in Config.BLOCKED_COMMANDS:
             reply(chat_id, f"'{cmd}' not supported (interactive)")
 
@@ -1233,15 +1623,16 @@ class BotHandler:
                         if cleaned_responses and cleaned_responses.strip():
                             reply(chat_id, cleaned_responses)
                             response_monitor.last_position = new_position
-                            print(f"[DEBUG] Sent partial response before stop")
+                            logger.debug("Sent partial response before stop")
             except Exception as e:
-                print(f"[DEBUG] Error checking for partial response: {e}")
+                logger.debug("Error checking for partial response: %s", e)
 
         # Now send escape to interrupt Claude
         if tmux_exists():
             tmux_send_escape()
 
         # Clean up pending file
+        typing_scheduler.remove(chat_id)
         if os.path.exists(Config.PENDING_FILE):
             os.remove(Config.PENDING_FILE)
 
@@ -1251,10 +1642,10 @@ class BotHandler:
         if not self._require_tmux(chat_id):
             return
         self._session_initialized = False
+        clear_session_caches()
         tmux_send_escape()
         time.sleep(0.2)
-        tmux_send("/clear")
-        tmux_send_enter()
+        tmux_send_line("/clear")
         reply(chat_id, "Cleared")
 
     def _start_claude_with_command(self, chat_id, command, message):
@@ -1263,13 +1654,12 @@ class BotHandler:
             return False
 
         self._session_initialized = False
+        # Claude needs a moment to consume each step, so only these are split
         tmux_send_escape()
         time.sleep(0.2)
-        tmux_send("/exit")
-        tmux_send_enter()
+        tmux_send_line("/exit")
         time.sleep(0.5)
-        tmux_send(command)
-        tmux_send_enter()
+        tmux_send_line(command)
         reply(chat_id, message)
         return True
 
@@ -1288,9 +1678,13 @@ class BotHandler:
             reply(chat_id, "No sessions")
             return
 
+        # 并行查找各会话 ID（每次查找都要扫描目录）
+        projects = [s.get("project", "") for s in sessions]
+        with ThreadPoolExecutor(max_workers=min(8, len(projects))) as pool:
+            session_ids = list(pool.map(get_session_id, projects))
+
         kb = [[{"text": "Continue most recent", "callback_data": "continue_recent"}]]
-        for s in sessions:
-            sid = get_session_id(s.get("project", ""))
+        for s, sid in zip(sessions, session_ids):
             if sid:
                 kb.append([{"text": s.get("display", "?")[:40] + "...", "callback_data": f"resume:{sid}"}])
 
@@ -1592,6 +1986,50 @@ class BotHandler:
             print(f"Error handling callback: {e}")
             reply(chat_id, f"Error: {str(e)}")
 
+    def _dispatch_update(self, update):
+        """Handle one update on a worker thread."""
+        update_id = update.get("update_id", 0)
+        try:
+            if "message" in update:
+                self.handle_message(update["message"])
+            elif "callback_query" in update:
+                self.handle_callback_query(update["callback_query"])
+        except Exception as e:
+            print(f"Error handling update {update_id}: {e}")
+
+    @staticmethod
+    def _update_chat_id(update):
+        """Chat an update belongs to (None if it has no chat)."""
+        if "message" in update:
+            return update["message"].get("chat", {}).get("id")
+        if "callback_query" in update:
+            return update["callback_query"].get("message", {}).get("chat", {}).get("id")
+        return None
+
+    def _enqueue_update(self, update):
+        """Queue an update behind any earlier ones from the same chat."""
+        chat_id = self._update_chat_id(update)
+        with self._chat_queues_lock:
+            pending = self._chat_queues.get(chat_id)
+            if pending is not None:
+                # A worker is already draining this chat; it will pick this up next
+                pending.append(update)
+                return
+            self._chat_queues[chat_id] = deque()
+        self.pool.submit(self._drain_chat, chat_id, update)
+
+    def _drain_chat(self, chat_id, update):
+        """Handle one chat's updates in arrival order on a single worker."""
+        while True:
+            self._dispatch_update(update)
+            with self._chat_queues_lock:
+                pending = self._chat_queues[chat_id]
+                if not pending:
+                    # Idle chats keep no entry
+                    del self._chat_queues[chat_id]
+                    return
+                update = pending.popleft()
+
     def poll_updates(self):
         """Main polling loop."""
         setup_bot_commands()
@@ -1610,20 +2048,14 @@ class BotHandler:
 
                     updates = result.get("result", [])
                     for update in updates:
-                        update_id = update.get("update_id", 0)
+                        # Handle on the worker pool so polling keeps pipelining
+                        self._enqueue_update(update)
+                        self.offset = update.get("update_id", 0) + 1
 
-                        try:
-                            if "message" in update:
-                                self.handle_message(update["message"])
-                            elif "callback_query" in update:
-                                self.handle_callback_query(update["callback_query"])
-                        except Exception as e:
-                            print(f"Error handling update {update_id}: {e}")
-
-                        self.offset = update_id + 1
+                    # Persist once per batch rather than once per update
+                    if updates:
                         self._save_offset(self.offset)
-
-                    if not updates:
+                    else:
                         time.sleep(1)
 
                 except KeyboardInterrupt:
@@ -1634,9 +2066,11 @@ class BotHandler:
                     time.sleep(5)
         finally:
             response_monitor.stop()
+            self.pool.shutdown(wait=False)
 
 
 def main():
+    logging.basicConfig(level=Config.LOG_LEVEL, format="[%(levelname)s] %(message)s")
     if not Config.BOT_TOKEN:
         print("Error: TELEGRAM_BOT_TOKEN not set")
         return 1
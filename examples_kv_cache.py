@@ -120,25 +120,27 @@ def example_3_attention_manager_integration():
 
     # 第一次构建 - 应未命中
     print("第一次构建提示词 (预期: 缓存未命中)...")
-    prompt1, cache_info1 = am.build_optimized_prompt_with_cache(
+    result1 = am.build_optimized_prompt_with_cache(
         user_input="如何测试KV-Cache性能？",
         chat_id=chat_id,
         ttl_seconds=30
     )
-    print(f"缓存命中: {cache_info1['cache_hit']}")
-    print(f"来源: {cache_info1.get('source', 'unknown')}")
+    prompt1 = result1.prompt
+    print(f"缓存命中: {result1.cache_hit}")
+    print(f"来源: {result1.source}")
     print(f"提示词长度: {len(prompt1)} 字符")
     print()
 
     # 第二次相同查询 - 应命中
     print("第二次相同查询 (预期: 缓存命中)...")
-    prompt2, cache_info2 = am.build_optimized_prompt_with_cache(
+    result2 = am.build_optimized_prompt_with_cache(
         user_input="如何测试KV-Cache性能？",
         chat_id=chat_id,
         ttl_seconds=30
     )
-    print(f"缓存命中: {cache_info2['cache_hit']}")
-    print(f"来源: {cache_info2.get('source', 'unknown')}")
+    prompt2 = result2.prompt
+    print(f"缓存命中: {result2.cache_hit}")
+    print(f"来源: {result2.source}")
     print(f"提示词长度: {len(prompt2)} 字符")
     print()
 
@@ -28,7 +28,7 @@ tail -n "+$LAST_USER_LINE" "$TRANSCRIPT_PATH" | \
 [ ! -s "$TMPFILE" ] && rm -f "$TMPFILE" "$PENDING_FILE" && exit 0
 
 python3 - "$TMPFILE" "$CHAT_ID" "$TELEGRAM_BOT_TOKEN" << 'PYEOF'
-import sys, re, json, urllib.request
+import sys, re, json, http.client
 
 tmpfile, chat_id, token = sys.argv[1], sys.argv[2], sys.argv[3]
 with open(tmpfile) as f:
@@ -60,19 +60,24 @@ for i, (lang, code) in enumerate(blocks):
 for i, code in enumerate(inlines):
     text = text.replace(f"\x00I{i}\x00", f'<code>{esc(code)}</code>')
 
+# One keep-alive connection, so the plain-text fallback reuses the TLS session
+conn = http.client.HTTPSConnection("api.telegram.org", timeout=10)
+
 def send(txt, mode=None):
     data = {"chat_id": chat_id, "text": txt}
     if mode:
         data["parse_mode"] = mode
     try:
-        req = urllib.request.Request(f"https://api.telegram.org/bot{token}/sendMessage", json.dumps(data).encode(), {"Content-Type": "application/json"})
-        return json.loads(urllib.request.urlopen(req, timeout=10).read()).get("ok")
+        conn.request("POST", f"/bot{token}/sendMessage", json.dumps(data).encode(), {"Content-Type": "application/json"})
+        return json.loads(conn.getresponse().read()).get("ok")
     except:
+        conn.close()
         return False
 
 if not send(text, "HTML"):
     with open(tmpfile) as f:
         send(f.read()[:4096])
+conn.close()
 PYEOF
 
 rm -f "$TMPFILE" "$PENDING_FILE"
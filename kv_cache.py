@@ -11,6 +11,7 @@ Based on Manus Context Engineering principles:
 import hashlib
 import json
 import sqlite3
+import threading
 import time
 from datetime import datetime, timedelta
 from pathlib import Path
@@ -50,8 +51,18 @@ class KVCacheManager:
 
         self._init_cache_db()
         self.stats = CacheStats()
+        self._stats_lock = threading.Lock()
         self._update_stats()
 
+    def _record_lookup(self, hit: bool):
+        """Count a cache lookup (hit/miss counters are plain ints)."""
+        with self._stats_lock:
+            if hit:
+                self.stats.hit_count += 1
+            else:
+                self.stats.miss_count += 1
+            self.stats.total_queries += 1
+
     def _init_cache_db(self):
         """Initialize cache database"""
         with sqlite3.connect(self.db_path) as conn:
@@ -123,8 +134,7 @@ class KVCacheManager:
 
                 row = cursor.fetchone()
                 if not row:
-                    self.stats.miss_count += 1
-                    self.stats.total_queries += 1
+                    self._record_lookup(False)
                     return None
 
                 ttl_seconds = row["ttl_seconds"]
@@ -134,8 +144,7 @@ class KVCacheManager:
                     # Cache expired, delete it
                     cursor.execute("DELETE FROM kv_cache WHERE cache_key = ?", (cache_key,))
                     conn.commit()
-                    self.stats.miss_count += 1
-                    self.stats.total_queries += 1
+                    self._record_lookup(False)
                     return None
 
                 # Update access statistics
@@ -147,14 +156,12 @@ class KVCacheManager:
                 """, (cache_key,))
                 conn.commit()
 
-                self.stats.hit_count += 1
-                self.stats.total_queries += 1
+                self._record_lookup(True)
                 return row["full_prompt"]
 
         except Exception as e:
             print(f"Error retrieving from KV-Cache: {e}")
-            self.stats.miss_count += 1
-            self.stats.total_queries += 1
+            self._record_lookup(False)
             return None
 
     def store_prompt(self, cache_key: str, full_prompt: str,
@@ -8,22 +8,151 @@ Integrated with ExternalMemory for tiered storage:
 
 import hashlib
 import json
+import logging
 import os
 import re
 import sqlite3
+import threading
 from contextlib import contextmanager
-from datetime import datetime
 from functools import wraps
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, Union, Callable
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union, Callable
 
 # Import ExternalMemory for tiered storage
 from external_memory import get_external_memory, ExternalMemoryRef
 
+try:
+    from blake3 import blake3
+except ImportError:  # Optional: faster hashing for memory IDs
+    blake3 = None
+
+if blake3 is not None:
+    def _hash(data: bytes) -> str:
+        return blake3(data).hexdigest(16)
+else:
+    def _hash(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()[:32]
+
+try:
+    import orjson
+except ImportError:  # Optional: faster metadata (de)serialization
+    orjson = None
+
+if orjson is not None:
+    def _dumps(obj: Any) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    _loads = orjson.loads
+else:
+    _dumps = json.dumps
+    _loads = json.loads
+
+
+logger = logging.getLogger(__name__)
 
 MEMORY_DIR = os.path.expanduser("~/.matecode")
 MEMORY_DB = os.path.join(MEMORY_DIR, "memory.db")
 
+# Fixed statements, shared so sqlite3's per-connection statement cache reuses them
+# (ADD_SQL stamps local time in milliseconds, which sorts consistently with older rows;
+# rows stamped in the same millisecond are ordered newest-first by seq)
+ADD_SQL = """INSERT OR REPLACE INTO memories
+                (id, user_id, content, timestamp, metadata, message_type)
+                VALUES (?, ?, ?, strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'), ?, ?)"""
+# CROSS JOIN pins the FTS table as the outer loop, so the planner cannot pick
+# a user_id index scan and probe the index once per memory
+SEARCH_SQL = """SELECT m.id, m.content, m.timestamp, m.metadata, s.rank
+                FROM memory_search s
+                CROSS JOIN memories m ON m.seq = s.rowid
+                WHERE memory_search MATCH ? AND m.user_id = ?
+                ORDER BY s.rank
+                LIMIT ?"""
+RECENT_SQL = """SELECT id, content, timestamp, metadata
+                FROM memories
+                WHERE user_id = ?
+                ORDER BY timestamp DESC, seq DESC
+                LIMIT ?"""
+BY_TYPE_SQL = """SELECT id, content, timestamp, metadata
+                 FROM memories
+                 WHERE user_id = ? AND message_type = ?
+                 ORDER BY timestamp DESC, seq DESC
+                 LIMIT ?"""
+DELETE_SQL = "DELETE FROM memories WHERE id = ? AND user_id = ?"
+DELETE_BY_QUERY_SQL = """DELETE FROM memories
+                         WHERE user_id = ? AND seq IN
+                             (SELECT rowid FROM memory_search WHERE memory_search MATCH ?)"""
+CLEAR_SQL = "DELETE FROM memories WHERE user_id = ?"
+STATS_SQL = """SELECT message_type, COUNT(*), MIN(timestamp), MAX(timestamp)
+               FROM memories
+               WHERE user_id = ?
+               GROUP BY message_type"""
+
+# format_for_prompt: header line plus blank line, and newline folding in one pass
+_PROMPT_HEADER = "【历史记忆】\n"
+_NEWLINE_TO_SPACE = str.maketrans({"\n": " ", "\r": " "})
+
+# Characters that are not allowed in an FTS5 query term
+_SANITIZE_RE = re.compile(r"[^\w\s\-_.]")
+
+
+class Memory:
+    """A stored memory entry.
+
+    Supports the dict-style access callers already use (``mem["content"]``,
+    ``mem.get("metadata")``); metadata JSON is only parsed when first read.
+    """
+
+    __slots__ = ("id", "content", "timestamp", "relevance", "_meta_raw", "_meta",
+                 "_external_ref_id", "_has_full_content")
+
+    _KEYS = frozenset(("id", "content", "timestamp", "metadata", "relevance",
+                       "_external_ref_id", "_has_full_content"))
+
+    def __init__(self, id: str, content: str, timestamp: Any, meta_raw: Optional[str],
+                 relevance: Optional[float] = None):
+        self.id = id
+        self.content = content
+        self.timestamp = timestamp
+        self._meta_raw = meta_raw
+        if relevance is not None:
+            self.relevance = relevance
+
+    @property
+    def metadata(self) -> Optional[Dict[str, Any]]:
+        try:
+            return self._meta
+        except AttributeError:
+            self._meta = _loads(self._meta_raw) if self._meta_raw else None
+            return self._meta
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._KEYS:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key not in self._KEYS or key == "metadata":
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._KEYS and (key == "metadata" or hasattr(self, key))
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Plain dict copy, e.g. for JSON output."""
+        return {key: self[key] for key in self._KEYS if key in self}
+
+    def __repr__(self) -> str:
+        return f"Memory({self.to_dict()!r})"
+
 
 class LocalMemory:
     """Local SQLite-based memory storage with FTS5 search.
@@ -40,6 +169,9 @@ class LocalMemory:
     # Threshold for external storage
     EXTERNAL_STORAGE_THRESHOLD = 500
 
+    # Max IDs bound into a single IN (...) clause
+    MAX_SQL_VARIABLES = 500
+
     def __init__(self, db_path: str = MEMORY_DB):
         self.db_path = db_path
         # Only create directory for file-based databases
@@ -48,14 +180,42 @@ class LocalMemory:
             if db_dir:  # Ensure db_dir is not empty
                 os.makedirs(db_dir, exist_ok=True)
         self._external = get_external_memory()
+        # One shared connection for the instance; autocommit mode with explicit
+        # transactions, serialized by the lock
+        self._conn = self._connect()
+        self._lock = threading.Lock()
         self._init_db()
+        # Reads get their own query-only connection so they never wait on a
+        # write under WAL. An in-memory database is private to its connection,
+        # so there reads share the write connection.
+        if db_path == ":memory:":
+            self._rconn, self._rlock = self._conn, self._lock
+        else:
+            self._rconn = self._connect(read_only=True)
+            self._rlock = threading.Lock()
 
     def _init_db(self) -> None:
         """Initialize SQLite database with FTS5."""
-        with self._get_connection() as conn:
+        with self._lock:
+            conn = self._conn
+            # WAL is persistent in the database file; set it once here
+            conn.execute("PRAGMA journal_mode=WAL")
+            # The FTS index is keyed by an explicit INTEGER PRIMARY KEY (seq):
+            # the implicit rowid of a TEXT-keyed table may be renumbered by
+            # VACUUM, which would silently detach the index from its rows.
+            # Older tables without seq are copied into the new layout.
+            columns = [r[1] for r in conn.execute("PRAGMA table_info(memories)")]
+            migrate = bool(columns) and "seq" not in columns
+            if migrate:
+                conn.execute("BEGIN")
+                for trigger in ("memories_ai", "memories_ad", "memories_au"):
+                    conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+                conn.execute("DROP TABLE IF EXISTS memory_search")
+                conn.execute("ALTER TABLE memories RENAME TO memories_old")
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS memories (
-                    id TEXT PRIMARY KEY,
+                    seq INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
                     user_id TEXT NOT NULL,
                     content TEXT NOT NULL,
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
@@ -63,63 +223,133 @@ class LocalMemory:
                     message_type TEXT DEFAULT 'conversation'
                 )
             """)
+            if migrate:
+                conn.execute("""
+                    INSERT INTO memories (id, user_id, content, timestamp, metadata, message_type)
+                    SELECT id, user_id, content, timestamp, metadata, message_type
+                    FROM memories_old ORDER BY rowid
+                """)
+                conn.execute("DROP TABLE memories_old")
+                conn.execute("COMMIT")
+            # FTS index over memories.content (external content, no second copy
+            # of the text). Older databases kept their own copy; rebuild those.
+            row = conn.execute(
+                "SELECT sql FROM sqlite_master WHERE name = 'memory_search'"
+            ).fetchone()
+            rebuild = row is None or "content_rowid='seq'" not in row[0]
+            if row is not None and rebuild:
+                conn.execute("DROP TABLE memory_search")
             conn.execute("""
                 CREATE VIRTUAL TABLE IF NOT EXISTS memory_search
-                USING fts5(content, content_rowid=rowid)
+                USING fts5(content, content='memories', content_rowid='seq')
             """)
+            # Keep the index in sync with memories
             conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_user_id ON memories(user_id)
+                CREATE TRIGGER IF NOT EXISTS memories_ai AFTER INSERT ON memories BEGIN
+                    INSERT INTO memory_search(rowid, content) VALUES (new.seq, new.content);
+                END
             """)
-            conn.commit()
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS memories_ad AFTER DELETE ON memories BEGIN
+                    INSERT INTO memory_search(memory_search, rowid, content)
+                    VALUES ('delete', old.seq, old.content);
+                END
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS memories_au AFTER UPDATE OF content ON memories BEGIN
+                    INSERT INTO memory_search(memory_search, rowid, content)
+                    VALUES ('delete', old.seq, old.content);
+                    INSERT INTO memory_search(rowid, content) VALUES (new.seq, new.content);
+                END
+            """)
+            if rebuild:
+                conn.execute("INSERT INTO memory_search(memory_search) VALUES ('rebuild')")
+            # Composite indexes serve get_recent/get_by_type in ORDER BY order
+            # without a sort step; they also cover plain user_id lookups
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_user_ts_seq
+                ON memories(user_id, timestamp DESC, seq DESC)
+            """)
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_user_type_ts_seq
+                ON memories(user_id, message_type, timestamp DESC, seq DESC)
+            """)
+            for index in ("idx_user_id", "idx_user_ts", "idx_user_type_ts"):
+                conn.execute(f"DROP INDEX IF EXISTS {index}")
+            # Refresh planner statistics; analysis_limit keeps this cheap on big databases
+            conn.execute("PRAGMA analysis_limit=1000")
+            conn.execute("ANALYZE")
+
+    # Per-connection settings: NORMAL sync is safe under WAL, 64MB page cache,
+    # 256MB mmap, temp tables in memory, wait up to 5s on a locked database
+    CONNECTION_PRAGMAS = (
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-65536",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA busy_timeout=5000",
+        # INSERT OR REPLACE only fires the FTS delete trigger with this on
+        "PRAGMA recursive_triggers=ON",
+    )
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """Open a connection with the tuned PRAGMAs applied."""
+        if read_only:
+            uri = Path(self.db_path).resolve().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        for pragma in self.CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        if read_only:
+            # Serve FTS/index pages straight from the OS page cache
+            conn.execute("PRAGMA mmap_size=1073741824")
+            conn.execute("PRAGMA query_only=ON")
+        return conn
 
     @contextmanager
-    def _get_connection(self):
-        """Context manager for database connections."""
-        conn = sqlite3.connect(self.db_path)
-        try:
-            yield conn
-        finally:
-            conn.close()
-
+    def _transaction(self):
+        """Run the block inside BEGIN/COMMIT on the shared connection."""
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                # Also covers a failed COMMIT (e.g. SQLITE_BUSY), which leaves the
+                # transaction open on the shared connection
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
 
     def _generate_id(self, user_id: str, content: str) -> str:
-        """Generate unique ID for memory entry."""
-        data = f"{user_id}:{content}:{datetime.now().isoformat()}"
-        return hashlib.md5(data.encode()).hexdigest()
-
-    def _row_to_dict(self, row: Tuple, include_relevance: bool = False) -> Dict[str, Any]:
-        """Convert database row to memory dictionary."""
-        result = {
-            "id": row[0],
-            "content": row[1],
-            "timestamp": row[2],
-            "metadata": json.loads(row[3]) if row[3] else None,
-        }
-        if include_relevance and len(row) > 4:
-            result["relevance"] = row[4]
-        return result
+        """Generate the ID for a memory entry.
 
-    def add(self, user_id: str, content: str, metadata: Optional[Dict[str, Any]] = None,
-            message_type: str = DEFAULT_MESSAGE_TYPE) -> bool:
-        """Add a memory entry with tiered storage.
-
-        - Content < 500 chars: stored directly in SQLite
-        - Content >= 500 chars: stored in file system, reference in SQLite
+        Derived from user and content only, so storing the same content again
+        replaces the earlier entry instead of duplicating it.
         """
+        return _hash(user_id.encode() + b"\x00" + content.encode())
+
+    def _row_to_memory(self, row: Tuple) -> Memory:
+        """Convert a (id, content, timestamp, metadata[, rank]) row to a Memory."""
+        return Memory(*row)
+
+    def _prepare_row(self, user_id: str, content: str, metadata: Optional[Dict[str, Any]],
+                     message_type: str) -> Optional[Tuple]:
+        """Build the memories row for one entry, moving large content to external storage."""
         if not content or not content.strip():
-            return False
+            return None
 
         content = content.strip()
 
         # Check if content should be stored externally (Manus: restorable compression)
-        external_ref = None
         if len(content) >= self.EXTERNAL_STORAGE_THRESHOLD:
             compressed, ref = self._external.compress_for_memory(
                 user_id, content, message_type, metadata
             )
             if ref:
                 content = compressed
-                external_ref = ref
                 # Add external ref info to metadata
                 if metadata is None:
                     metadata = {}
@@ -127,28 +357,50 @@ class LocalMemory:
 
         content = content[:self.MAX_CONTENT_LENGTH]
         memory_id = self._generate_id(user_id, content)
-        metadata_json = json.dumps(metadata) if metadata else None
+        metadata_json = _dumps(metadata) if metadata else None
+        return (memory_id, user_id, content, metadata_json, message_type)
+
+    def add(self, user_id: str, content: str, metadata: Optional[Dict[str, Any]] = None,
+            message_type: str = DEFAULT_MESSAGE_TYPE) -> bool:
+        """Add a memory entry with tiered storage.
+
+        - Content < 500 chars: stored directly in SQLite
+        - Content >= 500 chars: stored in file system, reference in SQLite
+        """
+        return self.add_many(user_id, [{
+            "content": content, "metadata": metadata, "message_type": message_type
+        }]) == 1
+
+    def add_many(self, user_id: str, items: Iterable[Dict[str, Any]]) -> int:
+        """Add several memory entries in one transaction.
+
+        Each item is a dict with ``content`` and optional ``metadata`` and
+        ``message_type``. Returns the number of entries stored.
+        """
+        rows = []
+        for item in items:
+            row = self._prepare_row(
+                user_id, item.get("content"), item.get("metadata"),
+                item.get("message_type", self.DEFAULT_MESSAGE_TYPE)
+            )
+            if row:
+                rows.append(row)
+        if not rows:
+            return 0
 
         try:
-            with self._get_connection() as conn:
-                conn.execute(
-                    """INSERT OR REPLACE INTO memories
-                       (id, user_id, content, timestamp, metadata, message_type)
-                       VALUES (?, ?, ?, ?, ?, ?)""",
-                    (memory_id, user_id, content, datetime.now(), metadata_json, message_type)
-                )
-                conn.execute(
-                    """INSERT OR REPLACE INTO memory_search(rowid, content)
-                       VALUES ((SELECT rowid FROM memories WHERE id = ?), ?)""",
-                    (memory_id, content)
+            # memory_search is updated by the memories_ai trigger
+            with self._transaction() as conn:
+                conn.executemany(
+                    ADD_SQL,
+                    rows
                 )
-                conn.commit()
-            return True
+            return len(rows)
         except sqlite3.Error as e:
-            print(f"Error adding memory: {e}")
-            return False
+            logger.error("Error adding memory: %s", e)
+            return 0
 
-    def search(self, user_id: str, query: str, limit: int = 5) -> List[Dict[str, Any]]:
+    def search(self, user_id: str, query: str, limit: int = 5) -> List[Memory]:
         """Search memories using FTS5."""
         if not query or not query.strip():
             return []
@@ -158,141 +410,146 @@ class LocalMemory:
             return []
 
         try:
-            with self._get_connection() as conn:
-                cursor = conn.execute(
-                    """SELECT m.id, m.content, m.timestamp, m.metadata, rank
-                       FROM memories m
-                       JOIN memory_search s ON m.rowid = s.rowid
-                       WHERE m.user_id = ? AND memory_search MATCH ?
-                       ORDER BY rank
-                       LIMIT ?""",
-                    (user_id, sanitized_query, limit)
+            with self._rlock:
+                cursor = self._rconn.execute(
+                    SEARCH_SQL,
+                    (sanitized_query, user_id, limit)
                 )
-                return [self._row_to_dict(row, include_relevance=True) for row in cursor.fetchall()]
+                rows = cursor.fetchall()
+            return [self._row_to_memory(row) for row in rows]
         except sqlite3.Error as e:
-            print(f"Error searching memories: {e}")
+            logger.error("Error searching memories: %s", e)
             return []
 
-    def get_recent(self, user_id: str, limit: int = 10) -> List[Dict[str, Any]]:
+    def get_recent(self, user_id: str, limit: int = 10) -> List[Memory]:
         """Get recent memories without search."""
         try:
-            with self._get_connection() as conn:
-                cursor = conn.execute(
-                    """SELECT id, content, timestamp, metadata
-                       FROM memories
-                       WHERE user_id = ?
-                       ORDER BY timestamp DESC
-                       LIMIT ?""",
+            with self._rlock:
+                cursor = self._rconn.execute(
+                    RECENT_SQL,
                     (user_id, limit)
                 )
-                return [self._row_to_dict(row) for row in cursor.fetchall()]
+                rows = cursor.fetchall()
+            return [self._row_to_memory(row) for row in rows]
         except sqlite3.Error as e:
-            print(f"Error getting recent memories: {e}")
+            logger.error("Error getting recent memories: %s", e)
             return []
 
-    def get_by_type(self, user_id: str, message_type: str, limit: int = 10) -> List[Dict[str, Any]]:
+    def get_by_type(self, user_id: str, message_type: str, limit: int = 10) -> List[Memory]:
         """Get memories by message type."""
         try:
-            with self._get_connection() as conn:
-                cursor = conn.execute(
-                    """SELECT id, content, timestamp, metadata
-                       FROM memories
-                       WHERE user_id = ? AND message_type = ?
-                       ORDER BY timestamp DESC
-                       LIMIT ?""",
+            with self._rlock:
+                cursor = self._rconn.execute(
+                    BY_TYPE_SQL,
                     (user_id, message_type, limit)
                 )
-                return [self._row_to_dict(row) for row in cursor.fetchall()]
+                rows = cursor.fetchall()
+            return [self._row_to_memory(row) for row in rows]
         except sqlite3.Error as e:
-            print(f"Error getting memories by type: {e}")
+            logger.error("Error getting memories by type: %s", e)
             return []
 
     def delete(self, user_id: str, memory_id: str) -> bool:
         """Delete a specific memory by ID."""
         try:
-            with self._get_connection() as conn:
+            with self._transaction() as conn:
                 cursor = conn.execute(
-                    "SELECT rowid FROM memories WHERE id = ? AND user_id = ?",
-                    (memory_id, user_id)
+                    DELETE_SQL, (memory_id, user_id)
                 )
-                row = cursor.fetchone()
-                if not row:
-                    return False
-
-                rowid = row[0]
-                conn.execute("DELETE FROM memory_search WHERE rowid = ?", (rowid,))
-                conn.execute("DELETE FROM memories WHERE id = ? AND user_id = ?", (memory_id, user_id))
-                conn.commit()
-            return True
+            return cursor.rowcount > 0
         except sqlite3.Error as e:
-            print(f"Error deleting memory: {e}")
+            logger.error("Error deleting memory: %s", e)
             return False
 
+    def delete_many(self, user_id: str, memory_ids: Iterable[str]) -> int:
+        """Delete several memories by ID in one transaction. Returns the number deleted."""
+        memory_ids = list(memory_ids)
+        if not memory_ids:
+            return 0
+
+        deleted = 0
+        try:
+            with self._transaction() as conn:
+                # Stay well under SQLite's host parameter limit
+                for i in range(0, len(memory_ids), self.MAX_SQL_VARIABLES):
+                    batch = memory_ids[i:i + self.MAX_SQL_VARIABLES]
+                    placeholders = ",".join("?" * len(batch))
+                    cursor = conn.execute(
+                        f"DELETE FROM memories WHERE user_id = ? AND id IN ({placeholders})",
+                        (user_id, *batch)
+                    )
+                    deleted += cursor.rowcount
+            return deleted
+        except sqlite3.Error as e:
+            logger.error("Error deleting memories: %s", e)
+            return 0
+
     def delete_by_query(self, user_id: str, query: str) -> int:
-        """Delete memories matching a query."""
-        matches = self.search(user_id, query, limit=100)
-        return sum(1 for mem in matches if self.delete(user_id, mem["id"]))
+        """Delete memories matching a query. Returns the number deleted."""
+        sanitized_query = self._sanitize_query(query) if query else ""
+        if not sanitized_query:
+            return 0
+
+        try:
+            with self._transaction() as conn:
+                cursor = conn.execute(
+                    DELETE_BY_QUERY_SQL,
+                    (user_id, sanitized_query)
+                )
+            return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.error("Error deleting memories: %s", e)
+            return 0
 
     def clear_all(self, user_id: str) -> bool:
         """Clear all memories for a user."""
         try:
-            with self._get_connection() as conn:
-                cursor = conn.execute("SELECT rowid FROM memories WHERE user_id = ?", (user_id,))
-                rowids = [row[0] for row in cursor.fetchall()]
-
-                for rowid in rowids:
-                    conn.execute("DELETE FROM memory_search WHERE rowid = ?", (rowid,))
-
-                conn.execute("DELETE FROM memories WHERE user_id = ?", (user_id,))
-                conn.commit()
+            with self._transaction() as conn:
+                conn.execute(CLEAR_SQL, (user_id,))
             return True
         except sqlite3.Error as e:
-            print(f"Error clearing memories: {e}")
+            logger.error("Error clearing memories: %s", e)
             return False
 
     def get_stats(self, user_id: str) -> Dict[str, Any]:
         """Get memory statistics for a user."""
         try:
-            with self._get_connection() as conn:
-                cursor = conn.execute(
-                    "SELECT COUNT(*), MAX(timestamp), MIN(timestamp) FROM memories WHERE user_id = ?",
-                    (user_id,)
-                )
-                count, newest, oldest = cursor.fetchone()
+            with self._rlock:
+                rows = self._rconn.execute(STATS_SQL, (user_id,)).fetchall()
 
-                type_cursor = conn.execute(
-                    "SELECT message_type, COUNT(*) FROM memories WHERE user_id = ? GROUP BY message_type",
-                    (user_id,)
-                )
-                by_type = dict(type_cursor.fetchall())
+            # One row per message type; fold into the totals here
+            by_type = {message_type: n for message_type, n, _, _ in rows}
+            count = sum(by_type.values())
+            newest = max((row[3] for row in rows if row[3] is not None), default=None)
+            oldest = min((row[2] for row in rows if row[2] is not None), default=None)
 
             return {
-                "count": count or 0,
+                "count": count,
                 "newest": newest,
                 "oldest": oldest,
                 "by_type": by_type
             }
         except sqlite3.Error as e:
-            print(f"Error getting stats: {e}")
+            logger.error("Error getting stats: %s", e)
             return {"count": 0, "newest": None, "oldest": None, "by_type": {}}
 
     def _sanitize_query(self, query: str) -> str:
         """Sanitize query string for FTS5."""
-        query = re.sub(r"[^\w\s\-_.]", " ", query)
-        words = [w for w in query.split() if len(w) >= 2]
-        return " AND ".join(f"{word}*" for word in words) if words else ""
+        terms = [w + "*" for w in _SANITIZE_RE.sub(" ", query).split() if len(w) >= 2]
+        return " AND ".join(terms)
 
-    def _expand_external_refs(self, memories: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Expand external references in memories when needed."""
-        expanded = []
+    def _expand_external_refs(self, memories: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """Expand external references in memories when needed.
+
+        Lazy, so a caller that stops early never touches the remaining entries.
+        """
         for mem in memories:
             metadata = mem.get("metadata") or {}
             if metadata.get("_is_external") and metadata.get("_external_ref"):
                 # Store reference info but keep compact for display
                 mem["_external_ref_id"] = metadata["_external_ref"]
                 mem["_has_full_content"] = True
-            expanded.append(mem)
-        return expanded
+            yield mem
 
     def get_full_content(self, memory: Dict[str, Any]) -> Optional[str]:
         """Retrieve full content for a memory with external reference."""
@@ -312,12 +569,10 @@ class LocalMemory:
         if not memories:
             return ""
 
-        memories = self._expand_external_refs(memories)
+        out = [_PROMPT_HEADER]
+        size = len(_PROMPT_HEADER) + 1
 
-        lines = ["【历史记忆】", ""]
-        current_len = len("【历史记忆】\n\n")
-
-        for mem in memories:
+        for mem in self._expand_external_refs(memories):
             content = mem["content"]
 
             # Optionally expand external references
@@ -326,16 +581,13 @@ class LocalMemory:
                 if full:
                     content = full
 
-            content = content.replace("\n", " ")
-            line = f"• {content}"
-
-            if current_len + len(line) + 1 > max_chars:
+            line = "• " + content.translate(_NEWLINE_TO_SPACE)
+            size += len(line) + 1
+            if size > max_chars:
                 break
+            out.append(line)
 
-            lines.append(line)
-            current_len += len(line) + 1
-
-        return "\n".join(lines)
+        return "\n".join(out)
 
     # =========================================================================
     # Todo.md Integration - Attention Redirection
@@ -355,14 +607,20 @@ class LocalMemory:
 
 
 _memory_instance: Optional[LocalMemory] = None
+_memory_instance_lock = threading.Lock()
 
 
 def get_memory() -> LocalMemory:
-    """Get or create singleton memory instance."""
+    """Get or create singleton memory instance (thread-safe)."""
     global _memory_instance
-    if _memory_instance is None:
-        _memory_instance = LocalMemory()
-    return _memory_instance
+    instance = _memory_instance
+    if instance is None:
+        with _memory_instance_lock:
+            # Another thread may have created it while we waited
+            if _memory_instance is None:
+                _memory_instance = LocalMemory()
+            instance = _memory_instance
+    return instance
 
 
 if __name__ == "__main__":
@@ -5,10 +5,14 @@ Similar to https://repo2txt.simplebasedomain.com/ but runs locally.
 """
 
 import os
+import re
 import sys
 import argparse
 import fnmatch
-from pathlib import Path
+import functools
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 
 
 DEFAULT_IGNORE_PATTERNS = [
@@ -107,245 +111,362 @@ DEFAULT_IGNORE_PATTERNS = [
 ]
 
 
-def should_ignore(path, ignore_patterns):
-    """Check if a path should be ignored based on patterns."""
-    path_parts = Path(path).parts
-    name = os.path.basename(path)
-
-    for pattern in ignore_patterns:
-        # Check if any part of the path matches
-        for part in path_parts:
-            if fnmatch.fnmatch(part, pattern):
-                return True
-        # Check if the name matches
-        if fnmatch.fnmatch(name, pattern):
-            return True
-    return False
+# Threads used to read files; I/O bound, so more than the CPU count
+READ_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Files under this size count toward Total Lines even when their content is skipped
+LINE_COUNT_MAX_SIZE = 1000000
+
+# Extension -> language/category label
+FILE_CATEGORIES = {
+    '.py': 'Python',
+    '.js': 'JavaScript',
+    '.ts': 'TypeScript',
+    '.jsx': 'React',
+    '.tsx': 'React/TS',
+    '.vue': 'Vue',
+    '.svelte': 'Svelte',
+    '.html': 'HTML',
+    '.css': 'CSS',
+    '.scss': 'SCSS',
+    '.sass': 'Sass',
+    '.less': 'Less',
+    '.json': 'JSON',
+    '.xml': 'XML',
+    '.yaml': 'YAML',
+    '.yml': 'YAML',
+    '.md': 'Markdown',
+    '.rs': 'Rust',
+    '.go': 'Go',
+    '.java': 'Java',
+    '.kt': 'Kotlin',
+    '.scala': 'Scala',
+    '.c': 'C',
+    '.cpp': 'C++',
+    '.h': 'C/C++ Header',
+    '.hpp': 'C++ Header',
+    '.cs': 'C#',
+    '.php': 'PHP',
+    '.rb': 'Ruby',
+    '.swift': 'Swift',
+    '.m': 'Objective-C',
+    '.mm': 'Objective-C++',
+    '.r': 'R',
+    '.jl': 'Julia',
+    '.ex': 'Elixir',
+    '.exs': 'Elixir Script',
+    '.erl': 'Erlang',
+    '.hs': 'Haskell',
+    '.ml': 'OCaml',
+    '.mli': 'OCaml Interface',
+    '.fs': 'F#',
+    '.fsx': 'F# Script',
+    '.clj': 'Clojure',
+    '.cljs': 'ClojureScript',
+    '.lua': 'Lua',
+    '.sh': 'Shell',
+    '.bash': 'Bash',
+    '.zsh': 'Zsh',
+    '.fish': 'Fish',
+    '.ps1': 'PowerShell',
+    '.sql': 'SQL',
+    '.dockerfile': 'Dockerfile',
+    '.dockerignore': 'Docker Ignore',
+    '.gitignore': 'Git Ignore',
+    '.gitattributes': 'Git Attributes',
+    '.env': 'Environment',
+    '.toml': 'TOML',
+    '.ini': 'INI',
+    '.cfg': 'Config',
+    '.conf': 'Config',
+    '.cmake': 'CMake',
+    '.make': 'Makefile',
+    '.mk': 'Makefile',
+    'Makefile': 'Makefile',
+    '.gradle': 'Gradle',
+    '.sbt': 'SBT',
+    '.ivy': 'Ivy',
+    '.pom': 'Maven POM',
+    '.proto': 'Protocol Buffers',
+    '.graphql': 'GraphQL',
+    '.prisma': 'Prisma',
+}
+
+
+def _is_glob(pattern):
+    return any(c in pattern for c in '*?[')
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_ignore_patterns(patterns):
+    """Compile a tuple of ignore patterns into a single-name predicate.
+
+    Literal names ('.git') become a set lookup and pure extension globs ('*.png')
+    a single str.endswith(tuple) call; only the remaining true globs use a regex.
+    Patterns only ever match single path components, so the predicate takes one name.
+    """
+    literals, suffixes, globs = set(), [], []
+    for p in patterns:
+        if not _is_glob(p):
+            literals.add(p)
+        elif p.startswith('*.') and not _is_glob(p[1:]):
+            suffixes.append(p[1:])
+        else:
+            globs.append(p)
+
+    literals, suffixes = frozenset(literals), tuple(suffixes)
+    glob_match = re.compile('|'.join(fnmatch.translate(p) for p in globs)).match if globs else None
+
+    def ignore_name(name):
+        return (name in literals or name.endswith(suffixes)
+                or (glob_match is not None and glob_match(name) is not None))
+
+    return ignore_name
 
 
 def get_file_extension(filename):
-    """Get file extension for categorization."""
-    return os.path.splitext(filename)[1].lower()
+    """Get file extension for categorization.
+
+    Same result as os.path.splitext(...)[1].lower() for '/'-separated paths,
+    without the generic path parsing.
+    """
+    name = filename[filename.rfind('/') + 1:]
+    i = name.rfind('.')
+    if i <= 0 or not name[:i].lstrip('.'):
+        return ''  # No dot, or only leading dots ('.gitignore')
+    return name[i:].lower()
 
 
 def categorize_file(filepath):
     """Categorize a file by its extension."""
-    ext = get_file_extension(filepath)
-    categories = {
-        '.py': 'Python',
-        '.js': 'JavaScript',
-        '.ts': 'TypeScript',
-        '.jsx': 'React',
-        '.tsx': 'React/TS',
-        '.vue': 'Vue',
-        '.svelte': 'Svelte',
-        '.html': 'HTML',
-        '.css': 'CSS',
-        '.scss': 'SCSS',
-        '.sass': 'Sass',
-        '.less': 'Less',
-        '.json': 'JSON',
-        '.xml': 'XML',
-        '.yaml': 'YAML',
-        '.yml': 'YAML',
-        '.md': 'Markdown',
-        '.rs': 'Rust',
-        '.go': 'Go',
-        '.java': 'Java',
-        '.kt': 'Kotlin',
-        '.scala': 'Scala',
-        '.c': 'C',
-        '.cpp': 'C++',
-        '.h': 'C/C++ Header',
-        '.hpp': 'C++ Header',
-        '.cs': 'C#',
-        '.php': 'PHP',
-        '.rb': 'Ruby',
-        '.swift': 'Swift',
-        '.m': 'Objective-C',
-        '.mm': 'Objective-C++',
-        '.r': 'R',
-        '.jl': 'Julia',
-        '.ex': 'Elixir',
-        '.exs': 'Elixir Script',
-        '.erl': 'Erlang',
-        '.hs': 'Haskell',
-        '.ml': 'OCaml',
-        '.mli': 'OCaml Interface',
-        '.fs': 'F#',
-        '.fsx': 'F# Script',
-        '.clj': 'Clojure',
-        '.cljs': 'ClojureScript',
-        '.lua': 'Lua',
-        '.sh': 'Shell',
-        '.bash': 'Bash',
-        '.zsh': 'Zsh',
-        '.fish': 'Fish',
-        '.ps1': 'PowerShell',
-        '.sql': 'SQL',
-        '.dockerfile': 'Dockerfile',
-        '.dockerignore': 'Docker Ignore',
-        '.gitignore': 'Git Ignore',
-        '.gitattributes': 'Git Attributes',
-        '.env': 'Environment',
-        '.toml': 'TOML',
-        '.ini': 'INI',
-        '.cfg': 'Config',
-        '.conf': 'Config',
-        '.cmake': 'CMake',
-        '.make': 'Makefile',
-        '.mk': 'Makefile',
-        'Makefile': 'Makefile',
-        '.gradle': 'Gradle',
-        '.sbt': 'SBT',
-        '.ivy': 'Ivy',
-        '.pom': 'Maven POM',
-        '.proto': 'Protocol Buffers',
-        '.graphql': 'GraphQL',
-        '.prisma': 'Prisma',
-    }
-    return categories.get(ext, 'Other')
+    return FILE_CATEGORIES.get(get_file_extension(filepath), 'Other')
 
 
 def collect_files(repo_path, ignore_patterns, include_extensions=None, exclude_extensions=None):
-    """Collect all files from the repository."""
+    """Collect all files from the repository.
+
+    Returns a sorted list of (relative path, size in bytes) tuples.
+    """
     files = []
+    # Patterns only ever match single path components, and ignored directories
+    # are never entered, so checking each entry's own name is enough
+    ignore_name = _compile_ignore_patterns(tuple(ignore_patterns))
+
+    # Explicit stack of (relative prefix, absolute dir); the relative path is
+    # built by concatenation ('/'-separated on every OS), so no os.path.join/relpath per file
+    stack = [("", repo_path)]
+    while stack:
+        rel_dir, abs_dir = stack.pop()
+        try:
+            entries = os.scandir(abs_dir)
+        except OSError:
+            continue  # Unreadable directory (os.walk skipped these silently too)
+
+        with entries:
+            for entry in entries:
+                rel_path = rel_dir + entry.name
+
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # Like os.walk: symlinked directories are not followed
+                    if not entry.is_symlink() and not ignore_name(entry.name):
+                        stack.append((rel_path + '/', entry.path))
+                    continue
+
+                # Skip ignored files
+                if ignore_name(entry.name):
+                    continue
+
+                # Check extension filters
+                ext = get_file_extension(entry.name)
+                if include_extensions and ext not in include_extensions:
+                    continue
+                if exclude_extensions and ext in exclude_extensions:
+                    continue
+
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    size = 0  # e.g. a dangling symlink; reading it reports the error
+                files.append((rel_path, size))
 
-    for root, dirs, filenames in os.walk(repo_path):
-        # Filter out ignored directories
-        dirs[:] = [d for d in dirs if not should_ignore(os.path.join(root, d), ignore_patterns)]
+    return sorted(files)
 
-        for filename in filenames:
-            filepath = os.path.join(root, filename)
-            rel_path = os.path.relpath(filepath, repo_path)
 
-            # Skip ignored files
-            if should_ignore(rel_path, ignore_patterns):
-                continue
+def generate_tree(files, repo_path):
+    """Yield the lines of a tree-like representation of the file structure."""
+    yield "=" * 80
+    yield "DIRECTORY STRUCTURE"
+    yield "=" * 80
+    yield ""
+
+    # files is sorted, so each directory's entries are contiguous and the
+    # tree can be rendered by comparing neighbouring paths; no nested dict
+    paths = [f.split('/') for f in files]
+
+    def common_depth(a, b):
+        depth = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            depth += 1
+        return depth
+
+    # Back to front: has_sibling[i][d] tells whether path i's node at depth d
+    # has a later sibling. The next path shares the nodes above the depth where
+    # it diverges and is that later sibling at exactly that depth.
+    has_sibling = [None] * len(paths)
+    following = None
+    for i in range(len(paths) - 1, -1, -1):
+        parts = paths[i]
+        if following is None:
+            has_sibling[i] = [False] * len(parts)
+        else:
+            depth = common_depth(parts, paths[i + 1])
+            has_sibling[i] = following[:depth] + [True] + [False] * (len(parts) - depth - 1)
+        following = has_sibling[i]
+
+    # Front to back: print only the components that differ from the previous path
+    previous = []
+    indents = [""]  # indents[d]: prefix for nodes at depth d on the current path
+    for parts, siblings in zip(paths, has_sibling):
+        depth = common_depth(parts, previous)
+        del indents[depth + 1:]
+        for d in range(depth, len(parts)):
+            connector = "├── " if siblings[d] else "└── "
+            yield f"{indents[d]}{connector}{parts[d]}"
+            indents.append(indents[d] + ("│   " if siblings[d] else "    "))
+        previous = parts
+
+
+def count_lines(full_path):
+    """Count lines the way read_file does, streaming the file in 64 KiB chunks."""
+    line_count = 0
+    prev_cr = False
+    last = b''
+    try:
+        with open(full_path, 'rb') as f:
+            for chunk in iter(functools.partial(f.read, 65536), b''):
+                if b'\0' in chunk:
+                    return 0  # Binary
+                line_count += chunk.count(b'\n') + chunk.count(b'\r') - chunk.count(b'\r\n')
+                if prev_cr and chunk.startswith(b'\n'):
+                    line_count -= 1  # \r\n split across two chunks
+                prev_cr = chunk.endswith(b'\r')
+                last = chunk[-1:]
+    except OSError:
+        return 0
+    if last and last not in (b'\n', b'\r'):
+        line_count += 1
+    return line_count
+
+
+def read_file(full_path, size, max_file_size=1000000):
+    """Read a file once for both the summary and the contents section.
+
+    Returns (line_count, text) where text is the content to emit or a
+    bracketed notice for large, binary or unreadable files.
+    """
+    # Skip very large files without loading them; their lines still count
+    if size > max_file_size:
+        line_count = count_lines(full_path) if size < LINE_COUNT_MAX_SIZE else 0
+        return line_count, f"[File too large: {size} bytes]"
+
+    try:
+        with open(full_path, 'rb') as f:
+            # Sniff the head for NUL bytes so binaries are not read in full
+            raw = f.read(4096)
+            if b'\0' in raw:
+                return 0, "[Binary file - content skipped]"
+            raw += f.read()
+    except Exception as e:
+        return 0, f"[Error reading file: {e}]"
+
+    if b'\0' in raw:
+        return 0, "[Binary file - content skipped]"
+
+    # Count lines on the bytes, the way len(readlines()) would in text mode:
+    # \n, \r\n and lone \r all end a line, and a final unterminated line counts
+    line_count = raw.count(b'\n')
+    if b'\r' in raw:
+        line_count += raw.count(b'\r') - raw.count(b'\r\n')
+    if raw and not raw.endswith((b'\n', b'\r')):
+        line_count += 1
+
+    content = raw.decode('utf-8', errors='replace')
+    if '\r' in content:
+        # Same newline translation as reading in text mode
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+
+    return line_count, content
+
+
+def read_files(files, repo_path, max_file_size=1000000):
+    """Read every (filepath, size) file exactly once.
+
+    Returns ([(filepath, category, text), ...], total_lines, type_counts); each
+    file is categorized once here for both the summary and the contents.
+    """
+    contents = []
+    total_lines = 0
+    type_counts = Counter()
 
-            # Check extension filters
-            ext = get_file_extension(filename)
-            if include_extensions and ext not in include_extensions:
-                continue
-            if exclude_extensions and ext in exclude_extensions:
-                continue
+    def read_one(entry):
+        filepath, size = entry
+        return read_file(os.path.join(repo_path, filepath), size, max_file_size)
 
-            files.append(rel_path)
+    # Reads overlap in a thread pool; map() keeps results in file order
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as pool:
+        for (filepath, _), (line_count, text) in zip(files, pool.map(read_one, files)):
+            category = categorize_file(filepath)
+            type_counts[category] += 1
+            total_lines += line_count
+            contents.append((filepath, category, text))
 
-    return sorted(files)
+    return contents, total_lines, type_counts
 
 
-def generate_tree(files, repo_path):
-    """Generate a tree-like representation of the file structure."""
-    lines = []
-    lines.append("=" * 80)
-    lines.append("DIRECTORY STRUCTURE")
-    lines.append("=" * 80)
-    lines.append("")
-
-    # Build tree structure
-    tree = {}
-    for f in files:
-        parts = f.split(os.sep)
-        current = tree
-        for part in parts:
-            if part not in current:
-                current[part] = {}
-            current = current[part]
-
-    def print_tree(node, prefix="", is_last=True):
-        items = list(node.items())
-        for i, (name, children) in enumerate(items):
-            is_last_item = (i == len(items) - 1)
-            connector = "└── " if is_last_item else "├── "
-            lines.append(f"{prefix}{connector}{name}")
-            if children:
-                new_prefix = prefix + ("    " if is_last_item else "│   ")
-                print_tree(children, new_prefix, is_last_item)
-
-    print_tree(tree)
-    return "\n".join(lines)
-
-
-def generate_file_contents(files, repo_path):
-    """Generate formatted content for each file."""
-    lines = []
-    lines.append("")
-    lines.append("=" * 80)
-    lines.append("FILE CONTENTS")
-    lines.append("=" * 80)
-    lines.append("")
-
-    for filepath in files:
-        full_path = os.path.join(repo_path, filepath)
-        category = categorize_file(filepath)
-
-        lines.append("-" * 80)
-        lines.append(f"File: {filepath}")
-        lines.append(f"Type: {category}")
-        lines.append("-" * 80)
-        lines.append("")
+def generate_file_contents(contents):
+    """Yield formatted content lines for each (filepath, category, text) entry."""
+    yield ""
+    yield "=" * 80
+    yield "FILE CONTENTS"
+    yield "=" * 80
+    yield ""
 
-        try:
-            # Try to read as text
-            with open(full_path, 'r', encoding='utf-8', errors='replace') as f:
-                content = f.read()
-
-            # Skip binary or very large files
-            if len(content) > 1000000:  # Skip files larger than 1MB
-                lines.append(f"[File too large: {len(content)} bytes]")
-            elif '\0' in content:
-                lines.append("[Binary file - content skipped]")
-            else:
-                lines.append(content)
-        except Exception as e:
-            lines.append(f"[Error reading file: {e}]")
-
-        lines.append("")
-        lines.append("")
-
-    return "\n".join(lines)
-
-
-def generate_summary(files, repo_path):
-    """Generate a summary of the repository."""
-    lines = []
-    lines.append("=" * 80)
-    lines.append("REPOSITORY SUMMARY")
-    lines.append("=" * 80)
-    lines.append("")
-
-    # Count files by type
-    type_counts = {}
-    total_lines = 0
-    total_size = 0
+    for filepath, category, text in contents:
+        yield "-" * 80
+        yield f"File: {filepath}"
+        yield f"Type: {category}"
+        yield "-" * 80
+        yield ""
+        yield text
+        yield ""
+        yield ""
 
-    for filepath in files:
-        category = categorize_file(filepath)
-        type_counts[category] = type_counts.get(category, 0) + 1
 
-        full_path = os.path.join(repo_path, filepath)
-        try:
-            size = os.path.getsize(full_path)
-            total_size += size
+def generate_summary(files, total_lines, type_counts):
+    """Yield the lines of a repository summary from (filepath, size) tuples."""
+    yield "=" * 80
+    yield "REPOSITORY SUMMARY"
+    yield "=" * 80
+    yield ""
 
-            if size < 1000000:  # Only count lines for reasonably sized files
-                with open(full_path, 'r', encoding='utf-8', errors='replace') as f:
-                    total_lines += len(f.readlines())
-        except:
-            pass
+    total_size = sum(size for _, size in files)
 
-    lines.append(f"Total Files: {len(files)}")
-    lines.append(f"Total Lines: {total_lines:,}")
-    lines.append(f"Total Size: {total_size / 1024:.1f} KB")
-    lines.append("")
-    lines.append("Files by Type:")
+    yield f"Total Files: {len(files)}"
+    yield f"Total Lines: {total_lines:,}"
+    yield f"Total Size: {total_size / 1024:.1f} KB"
+    yield ""
+    yield "Files by Type:"
 
-    for file_type, count in sorted(type_counts.items(), key=lambda x: -x[1]):
-        lines.append(f"  {file_type}: {count}")
+    for file_type, count in type_counts.most_common():
+        yield f"  {file_type}: {count}"
 
-    lines.append("")
-    return "\n".join(lines)
+    yield ""
 
 
 def main():
@@ -393,26 +514,28 @@ def main():
     files = collect_files(repo_path, ignore_patterns, include_extensions, exclude_extensions)
     print(f"Found {len(files)} files", file=sys.stderr)
 
-    # Generate output
-    output_lines = []
+    # Read each file once; the summary and the contents share the result
+    contents, total_lines, type_counts = read_files(files, repo_path, args.max_file_size)
+
+    # Generate output lazily, section by section
+    sections = []
 
     if not args.no_summary:
-        output_lines.append(generate_summary(files, repo_path))
+        sections.append(generate_summary(files, total_lines, type_counts))
 
     if not args.no_tree:
-        output_lines.append(generate_tree(files, repo_path))
-
-    output_lines.append(generate_file_contents(files, repo_path))
+        sections.append(generate_tree([f for f, _ in files], repo_path))
 
-    # Write output
-    result = "\n".join(output_lines)
+    sections.append(generate_file_contents(contents))
 
+    # Stream lines straight to the destination instead of joining one huge string
+    lines = (line + "\n" for line in chain.from_iterable(sections))
     if args.output:
         with open(args.output, 'w', encoding='utf-8') as f:
-            f.write(result)
+            f.writelines(lines)
         print(f"Output written to {args.output}", file=sys.stderr)
     else:
-        print(result)
+        sys.stdout.writelines(lines)
 
 
 if __name__ == '__main__':